@@ -8,9 +8,15 @@ Code Utils
 """
 
 import sys
+import functools
+import heapq
 import importlib
+import itertools
 import os
 import re
+import threading
+import time
+import weakref
 from operator import itemgetter
 
 __singleton_instances = {}
@@ -42,6 +48,137 @@ def static_singleton(*args, **kwargs):
     return __static_singleton_wrapper
 
 
+class _SingletonEntry(object):
+    __slots__ = ('factory', 'args', 'kwargs', 'teardown', 'reset_after_fork', 'instance', 'built', 'lock')
+
+    def __init__(self, factory, args, kwargs, teardown, reset_after_fork):
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+        self.teardown = teardown
+        self.reset_after_fork = reset_after_fork
+        self.instance = None
+        self.built = False
+        self.lock = threading.Lock()
+
+
+__singleton_registry = {}
+__singleton_registry_lock = threading.Lock()
+
+
+def register_singleton(key, factory, args=(), kwargs=None, teardown=None, reset_after_fork=True):
+    """
+    Registers a process-wide singleton. The instance is built lazily on first get_singleton(key) call.
+
+    :param key:                 key to retrieve the singleton (usually the class)
+    :param factory:             callable building the instance (usually the class)
+    :param args:                positional arguments given to the factory
+    :param kwargs:              keyword arguments given to the factory
+    :param teardown:            callable called with the instance when the singleton is reset (i.e. lambda db: db.close())
+    :param reset_after_fork:    if True, the instance is dropped in forked child processes and rebuilt on next access
+                                (teardown is not called in the child, as the resource still belongs to the parent)
+    """
+    with __singleton_registry_lock:
+        __singleton_registry[key] = _SingletonEntry(factory, tuple(args), dict(kwargs or {}), teardown, reset_after_fork)
+
+
+def get_singleton(key):
+    """
+    Returns the singleton instance registered for key, building it on first access (thread safe).
+    """
+    entry = __singleton_registry[key]
+    if entry.built:
+        return entry.instance
+    with entry.lock:
+        if not entry.built:
+            entry.instance = entry.factory(*entry.args, **entry.kwargs)
+            entry.built = True
+    return entry.instance
+
+
+def replace_singleton(key, instance):
+    """
+    Replaces the singleton instance registered for key (useful for tests or hot reconfiguration).
+    Returns the previous instance (None if it was not built yet).
+    """
+    entry = __singleton_registry[key]
+    with entry.lock:
+        previous = entry.instance
+        entry.instance = instance
+        entry.built = True
+    return previous
+
+
+def reset_singleton(key, teardown=True):
+    """
+    Drops the singleton instance registered for key, it will be rebuilt on next access.
+    If teardown is True, the teardown function given at registration is called with the dropped instance.
+    """
+    entry = __singleton_registry[key]
+    with entry.lock:
+        instance, built = entry.instance, entry.built
+        entry.instance = None
+        entry.built = False
+    if built and teardown and entry.teardown:
+        entry.teardown(instance)
+
+
+def reset_singletons(teardown=True):
+    """
+    Drops all singleton instances. See reset_singleton.
+    """
+    for key in list(__singleton_registry.keys()):
+        reset_singleton(key, teardown=teardown)
+
+
+def get_singleton_instances():
+    """
+    Returns a dict of all registered singletons keys with their instance (None if not built yet).
+    """
+    return dict([(key, entry.instance) for (key, entry) in list(__singleton_registry.items())])
+
+
+def _reset_singletons_after_fork():
+    global __singleton_registry_lock
+    # locks may have been held by another thread of the parent at fork time
+    __singleton_registry_lock = threading.Lock()
+    for entry in __singleton_registry.values():
+        entry.lock = threading.Lock()
+        if entry.reset_after_fork:
+            entry.instance = None
+            entry.built = False
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_singletons_after_fork)
+
+
+def singleton(*args, **kwargs):
+    """
+    LAZY Singleton Design Pattern Decorator
+    Class is registered as a singleton (see register_singleton), and initialized with arguments passed into the decorator
+    on first access to Class.get_instance(). Contrary to static_singleton, the class itself is kept.
+    The instance is dropped in forked child processes and rebuilt on first access.
+
+    :Usage:
+     >>> @singleton('yop')
+        class Bob(Person):
+            def __init__(self, arg1):
+                self.info = arg1
+            def says(self):
+                print self.info
+        Bob.get_instance().says() # instance is created here, it will display 'yop'
+        Bob.get_instance() is get_singleton(Bob) # True
+    """
+
+    def __singleton_wrapper(cls):
+        register_singleton(cls, cls, args=args, kwargs=kwargs)
+        cls.get_instance = classmethod(get_singleton)
+        return cls
+
+    return __singleton_wrapper
+
+
 class cached_property(object):
     """
     Method Descriptor (non-data) for building an attribute on-demand on first use.
@@ -142,12 +279,21 @@ class ProcessException(Exception):
         return "%s - Process ID : %s" % (super(ProcessException, self).__str__(), os.getpid())
 
 
+__documentation_cache = weakref.WeakKeyDictionary()
+__doc_field_re = re.compile(r"^\s*:", re.MULTILINE)
+__doc_param_re = re.compile(r":param ([^\s]*): (.*)\n")
+__doc_returns_re = re.compile(r":returns:(.*)", re.MULTILINE | re.DOTALL)
+__camel_case_re = re.compile(r"([a-z0-9])([A-Z])")
+
+
 def get_method_documentation(method):
     """
     This function uses "inspect" to retrieve information about a method.
 
     Also, if you place comment on the method, method can be docummented with "reStructured Text".
 
+    Results are cached per function (weak references), a copy of the cached dict is returned.
+
     :param method:    method to describe
 
     :returns:
@@ -170,37 +316,69 @@ def get_method_documentation(method):
             }
         }
     """
-    from inspect import getargspec
+    return _copy_documentation(_get_method_documentation(method))
+
+
+def _copy_documentation(value):
+    """
+    Copies the dicts and lists of a documentation, leaving other values (i.e. parameter defaults) as they are.
+    """
+    if isinstance(value, dict):
+        return dict((key, _copy_documentation(item)) for (key, item) in value.items())
+    if isinstance(value, list):
+        return [_copy_documentation(item) for item in value]
+    return value
+
+
+def _get_method_documentation(method, skip_first=True):
+    func = getattr(method, '__func__', method)
+    try:
+        cached = __documentation_cache.get(func, None)
+    except TypeError:  # not weak referenceable (builtins...)
+        return _build_method_documentation(method, skip_first)
+    if cached is None:
+        cached = __documentation_cache[func] = {}
+    if skip_first not in cached:
+        cached[skip_first] = _build_method_documentation(func, skip_first)
+    return cached[skip_first]
+
+
+def _build_method_documentation(method, skip_first):
+    import inspect  # not imported at module level, it is slow to import
     result = {
         'name': method.__name__,
         'friendly_name': ' '.join([name.capitalize() for name in method.__name__.split('_')]),
     }
-    arg_specs = getargspec(method)
-    arguments = {}
+    try:
+        parameters = list(inspect.signature(method).parameters.values())
+    except (TypeError, ValueError):  # some builtins have no signature
+        parameters = []
+    parameters = [p for p in parameters if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)]
+    if skip_first and parameters and parameters[0].kind != parameters[0].KEYWORD_ONLY:
+        parameters = parameters[1:]
 
-    if not arg_specs.defaults:
-        if len(arg_specs.args[1:]) > 0:
-            arguments['required'] = list(arg_specs.args[1:])
-    else:
-        if len(arg_specs.args[1:-(len(arg_specs.defaults))]):
-            arguments['required'] = list(arg_specs.args[1:-(len(arg_specs.defaults))])
-        arguments['optional'] = {}
-        for i in range(len(arg_specs.defaults)):
-            arguments['optional'][arg_specs.args[-(len(arg_specs.defaults)) + i]] = arg_specs.defaults[i]
+    arguments = {}
+    required = [p.name for p in parameters if p.default is p.empty]
+    optional = dict([(p.name, p.default) for p in parameters if p.default is not p.empty])
+    if required:
+        arguments['required'] = required
+    if optional:
+        arguments['optional'] = optional
     if arguments != {}:
         result['parameters'] = arguments
 
-    doc = method.__doc__.strip() if method.__doc__ else ''
-    if ':' in method.__doc__:
-        doc = {'summary': method.__doc__[0:doc.find('  :')].strip()}
-        params = re.findall(r":param ([^\s]*): (.*)\n", method.__doc__)
+    raw_doc = method.__doc__ or ''
+    doc = raw_doc.strip()
+    if ':' in doc:
+        field = __doc_field_re.search(raw_doc)
+        doc = {'summary': (raw_doc[0:field.start()] if field else raw_doc).strip()}
+        params = __doc_param_re.findall(raw_doc)
         if len(params) > 0:
             doc['parameters'] = {}
             for param in params:
                 doc['parameters'][param[0]] = param[1].strip()
 
-        regex = re.compile(r":returns:(.*)", re.MULTILINE | re.DOTALL)
-        returns = regex.search(method.__doc__)
+        returns = __doc_returns_re.search(raw_doc)
         if returns and returns.group(0):
             doc['return'] = returns.group(0).replace(':returns:', '').replace('\n        ', '\n').strip()
     if doc != '':
@@ -208,16 +386,154 @@ def get_method_documentation(method):
     return result
 
 
-def get_subclasses(klass):
+def document_class(cls):
+    """
+    Builds the documentation of a whole class in one pass : every public method (not starting with an underscore _)
+    is described with get_method_documentation.
+
+    :param cls:    class to describe
+
+    :returns:
+        {
+            'name'          : <string> - name of the class,
+            'friendly_name' : <string> - friendly name of the class,
+            'help'          : <string> - class docstring,
+            'methods'       : {
+                'method_name'  : <dict> - see get_method_documentation,
+            }
+        }
+    """
+    result = {
+        'name': cls.__name__,
+        'friendly_name': __camel_case_re.sub(r'\1 \2', cls.__name__),
+        'methods': {},
+    }
+    if cls.__doc__ and cls.__doc__.strip():
+        result['help'] = cls.__doc__.strip()
+
+    import inspect  # not imported at module level, it is slow to import
+    for name in dir(cls):
+        if name.startswith('_'):
+            continue
+        static_attr = inspect.getattr_static(cls, name)
+        if isinstance(static_attr, staticmethod):
+            result['methods'][name] = _get_method_documentation(static_attr.__func__, skip_first=False)
+        elif isinstance(static_attr, classmethod):
+            result['methods'][name] = _get_method_documentation(static_attr.__func__, skip_first=True)
+        elif inspect.isfunction(static_attr):
+            result['methods'][name] = _get_method_documentation(static_attr, skip_first=True)
+    return _copy_documentation(result)
+
+
+__subclasses_cache = weakref.WeakKeyDictionary()
+__subclasses_generation = [0]
+
+
+def _bump_subclasses_generation(*args):
+    """
+    Invalidates the cached subclasses of TrackSubclasses hierarchies (a class was created or garbage collected).
+    """
+    __subclasses_generation[0] += 1
+
+
+class TrackSubclasses(object):
+    """
+    Base class making get_subclasses cache hits cheap for its hierarchy : every subclass creation bumps a generation
+    counter, so a cached result is validated in constant time instead of by walking the hierarchy again.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _bump_subclasses_generation()
+
+
+def _walk_subclasses(klass):
+    """
+    Iterative (non recursive) walk over all subclasses of a class.
+    Returns the list of subclasses (each class once) and the number of direct subclasses of every visited class,
+    classes being held by weak references so that the cache does not keep them alive.
+    """
+    seen = set()
+    subclasses = []
+    counts = []
+    stack = [klass]
+    while stack:
+        current = stack.pop()
+        children = type.__subclasses__(current)
+        counts.append((weakref.ref(current), len(children)))
+        for child in children:
+            if child not in seen:
+                seen.add(child)
+                # a garbage collected subclass invalidates the cached TrackSubclasses hierarchies
+                subclasses.append(weakref.ref(child, _bump_subclasses_generation))
+                stack.append(child)
+    return subclasses, counts
+
+
+def _is_subclasses_cache_valid(counts):
+    for (klass_ref, count) in counts:
+        klass = klass_ref()
+        if klass is None or len(type.__subclasses__(klass)) != count:
+            return False
+    return True
+
+
+def _get_cached_subclasses(klass):
+    """
+    Returns the subclasses of a class and their positions in that list by name (the first class found for each name).
+    """
     assert isinstance(klass, type)
-    klasses = klass.__subclasses__()
-    klasses2 = klasses
-    for y in klasses:
-        klasses2 += get_subclasses(y)
-    return list(set(klasses2))
+    entry = __subclasses_cache.get(klass, None)
+    if entry is not None:
+        (subclass_refs, counts, index, generation) = entry
+        if issubclass(klass, TrackSubclasses):
+            valid = generation == __subclasses_generation[0]
+        else:
+            valid = _is_subclasses_cache_valid(counts)
+        if valid:
+            subclasses = [ref() for ref in subclass_refs]
+            if None not in subclasses:
+                return subclasses, index
+    generation = __subclasses_generation[0]
+    (subclass_refs, counts) = _walk_subclasses(klass)
+    subclasses = [ref() for ref in subclass_refs]
+    # the index holds positions in the subclasses list, not the classes themselves
+    index = {}
+    for (position, subclass) in enumerate(subclasses):
+        index.setdefault(subclass.__name__, position)
+    __subclasses_cache[klass] = (subclass_refs, counts, index, generation)
+    return subclasses, index
 
 
-class SerializableObject(object):
+def get_subclasses(klass):
+    """
+    Returns the list of all subclasses (direct or not) of a class.
+
+    Result is cached per class and automatically invalidated as soon as a new subclass is defined
+    (or garbage collected) anywhere under that class hierarchy.
+    Validating a cached result costs a call to type.__subclasses__ per class of the hierarchy (O(N)), except for
+    TrackSubclasses hierarchies which are validated in constant time.
+    """
+    return _get_cached_subclasses(klass)[0]
+
+
+def get_subclasses_index(klass):
+    """
+    Returns a dict of all subclasses (direct or not) of a class, indexed by class name.
+    If several subclasses share the same name, the first one found is kept.
+    """
+    (subclasses, index) = _get_cached_subclasses(klass)
+    return dict((name, subclasses[position]) for (name, position) in index.items())
+
+
+def clear_subclasses_cache():
+    """
+    Clears the get_subclasses cache.
+    """
+    __subclasses_cache.clear()
+
+
+class SerializableObject(TrackSubclasses):
     """
     Serializable object : allow to export an object as a dict or to fill an object from a dict
     """
@@ -327,6 +643,142 @@ def sort_dictionary_list(dict_list, sort_key):
     return dict_list
 
 
+def _normalize_sort_keys(keys):
+    """
+    Normalizes sort keys to a list of (key, reverse) tuples.
+    Keys can be given as a single key, a list of keys, or a list of (key, 'asc'|'desc') tuples.
+    """
+    if isinstance(keys, str) or (isinstance(keys, tuple) and len(keys) == 2 and keys[1] in ('asc', 'desc')):
+        keys = [keys]
+    result = []
+    for key in keys:
+        if isinstance(key, tuple):
+            (key, order) = key
+        else:
+            order = 'asc'
+        if order not in ('asc', 'desc'):
+            raise ValueError("Invalid sort order %r for key %r (should be 'asc' or 'desc')" % (order, key))
+        result.append((key, order == 'desc'))
+    return result
+
+
+def _record_key_function(key, reverse, missing):
+    """
+    Returns a key function for a single record key, placing records missing that key first or last.
+    """
+    if missing not in ('first', 'last', 'error'):
+        raise ValueError("Invalid missing value %r (should be 'first', 'last' or 'error')" % missing)
+    if missing == 'error':
+        return itemgetter(key)
+    # flag is compared before the value, so missing values never get compared to actual values
+    missing_flag = 1 if (missing == 'last') != reverse else -1
+
+    def key_function(record):
+        try:
+            return 0, record[key]
+        except KeyError:
+            return missing_flag, None
+    return key_function
+
+
+def _record_cmp_function(keys, missing):
+    key_functions = [(_record_key_function(key, reverse, missing), reverse) for (key, reverse) in keys]
+
+    def cmp_function(a, b):
+        for (key_function, reverse) in key_functions:
+            value_a = key_function(a)
+            value_b = key_function(b)
+            if value_a == value_b:
+                continue
+            if value_a < value_b:
+                return 1 if reverse else -1
+            return -1 if reverse else 1
+        return 0
+    return cmp_function
+
+
+def sort_records(records, keys, missing='last'):
+    """
+    Sorts records (dictionaries) on several keys, each one ascending or descending.
+    Sort is stable and a new list is returned, records can be any iterable.
+
+    :param records:    iterable of dictionaries
+    :param keys:       key, list of keys or list of (key, 'asc'|'desc') tuples, i.e. [('ts', 'desc'), ('name', 'asc')]
+    :param missing:    'last' or 'first' to place records missing a key at the end or the beginning, 'error' to raise KeyError
+
+    Test sorting a list of dictionaries:
+        >>> sort_records([{'a': 1, 'b': 2}, {'a': 2}, {'a': 1, 'b': 3}], [('a', 'asc'), ('b', 'desc')])
+        [{'a': 1, 'b': 3}, {'a': 1, 'b': 2}, {'a': 2}]
+    """
+    result = list(records)
+    # Python sort is stable, so sorting successively on each key (last key first) gives a multi-key sort
+    for (key, reverse) in reversed(_normalize_sort_keys(keys)):
+        result.sort(key=_record_key_function(key, reverse, missing), reverse=reverse)
+    return result
+
+
+def top_k(records, k, keys, missing='last'):
+    """
+    Returns the k first records (dictionaries) as they would be sorted by sort_records, without sorting all of them.
+    Uses a heap, memory usage is proportional to k only.
+
+    :param records:    iterable of dictionaries
+    :param k:          number of records to return
+    :param keys:       see sort_records
+    :param missing:    see sort_records
+    """
+    cmp_function = _record_cmp_function(_normalize_sort_keys(keys), missing)
+    return heapq.nsmallest(k, records, key=functools.cmp_to_key(cmp_function))
+
+
+def external_sort_records(records, keys, missing='last', chunk_size=100000, temp_folder=None):
+    """
+    Sorts records (dictionaries) like sort_records, but without keeping them all in memory.
+    Records are sorted by chunks of chunk_size records, each chunk being spilled to a temporary file,
+    and the sorted chunks are then merged. This is a generator : sorted records are yielded one by one.
+
+    :param records:       iterable of dictionaries (records must be picklable)
+    :param keys:          see sort_records
+    :param missing:       see sort_records
+    :param chunk_size:    maximum number of records kept in memory at once
+    :param temp_folder:   folder where temporary files are written (system default if not set)
+    """
+    import pickle
+    import tempfile
+    chunk_files = []
+    try:
+        iterator = iter(records)
+        while True:
+            chunk = sort_records(itertools.islice(iterator, chunk_size), keys, missing=missing)
+            if len(chunk) < chunk_size and not chunk_files:
+                # everything fits in memory, no need to spill anything to disk
+                for record in chunk:
+                    yield record
+                return
+            if not chunk:
+                break
+            chunk_file = tempfile.TemporaryFile(dir=temp_folder)
+            chunk_files.append(chunk_file)
+            for record in chunk:
+                pickle.dump(record, chunk_file, pickle.HIGHEST_PROTOCOL)
+            chunk_file.seek(0)
+            del chunk
+
+        def read_chunk(chunk_file):
+            while True:
+                try:
+                    yield pickle.load(chunk_file)
+                except EOFError:
+                    return
+
+        merge_key = functools.cmp_to_key(_record_cmp_function(_normalize_sort_keys(keys), missing))
+        for record in heapq.merge(*[read_chunk(f) for f in chunk_files], key=merge_key):
+            yield record
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+
 def get_app_name():
     mod = sys.modules.get('__main__', sys.modules[__name__])
     if '__file__' in dir(mod):
@@ -336,41 +788,115 @@ def get_app_name():
         script_folder = sys.path[0] if sys.path[0] != '' else sys.path[1]
         app_name = os.path.split(script_folder)[1].replace('.pyc', '').replace('.py', '')
     return script_folder, app_name
+__import_timings = {}
+__import_timing_finder = None
 
 
-def lazy_load_module(name):
+def _record_import_timing(name, duration):
+    __import_timings[name] = duration
+
+
+class _TimedLoader(object):
+    """
+    Loader wrapper recording the duration of the module execution.
+    Any other attribute is delegated to the wrapped loader.
     """
-    Lazy load module function.
-    Use:
-        lazy_load_module(__name__)
-    in a __init__.py package file containing sub modules.
 
-    This allows to import the base module, but access those easily without importing each.
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, attr):
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            _record_import_timing(module.__name__, time.perf_counter() - start)
+
+
+class _ImportTimingFinder(object):
     """
-    sys.modules[name] = LazyLoader(name)
-    return
+    sys.meta_path finder timing the import of every sub module of the given packages.
+    The module spec is looked up using the other finders, only its loader is wrapped.
+    """
+
+    def __init__(self, packages):
+        self.prefixes = tuple(package + '.' for package in packages)
+
+    def find_spec(self, fullname, path, target=None):
+        if not fullname.startswith(self.prefixes):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader)
+                return spec
+        return None
 
 
-class LazyLoader:
+def enable_import_timing(enabled=True, packages=None):
     """
-    Module Wrapper Class
-    See here for wrapping module class : http://stackoverflow.com/questions/2447353/getattr-on-a-module
-    Also does lazy loading of sub modules.
+    Enables (or disables) the recording of sub modules import durations.
+    Every sub module import of the packages is timed (lazy loading, import statements and importlib),
+    only modules that are not imported yet are recorded.
+    Timings can then be retrieved with get_import_timings().
+
+    :param enabled: True to install the import timing hook, False to remove it
+    :param packages: list of package names to record, defaults to this package
     """
+    global __import_timing_finder
+    if __import_timing_finder is not None:
+        if __import_timing_finder in sys.meta_path:
+            sys.meta_path.remove(__import_timing_finder)
+        __import_timing_finder = None
+    if enabled:
+        __import_timing_finder = _ImportTimingFinder(packages or [__name__.rpartition('.')[0] or __name__])
+        sys.meta_path.insert(0, __import_timing_finder)
 
-    def __init__(self, name):
-        self.__module_name = name
-        self.__wrapped_module = sys.modules[self.__module_name]
-        self.__submodule_imports = {}
 
-    def __getattr__(self, name):
-        """
-        Lazy loading module
-        """
-        if name.startswith('__'):  # importing needs access to some private reserved __*__ functions...
-            return getattr(self.__wrapped_module, name)
+def get_import_timings():
+    """
+    Returns a dict of recorded sub module import durations (in seconds), indexed by full module name.
+    Durations include the import of the sub module dependencies that were not already loaded.
+    """
+    return dict(__import_timings)
+
+
+def lazy_load_module(name):
+    """
+    Lazy load module function.
+    Use:
+        lazy_load_module(__name__)
+    in a __init__.py package file containing sub modules.
 
-        if not self.__submodule_imports.get(name, None):
-            self.__submodule_imports[name] = importlib.import_module('.' + name, package=self.__module_name)
+    This allows to import the base module, but access those easily without importing each.
+    It installs module level __getattr__ and __dir__ functions (PEP 562) in the package.
+    """
+    module = sys.modules[name]
 
-        return self.__submodule_imports.get(name, None)
\ No newline at end of file
+    def __getattr__(attr):
+        if attr.startswith('__'):
+            raise AttributeError("module %r has no attribute %r" % (name, attr))
+        try:
+            return importlib.import_module('.' + attr, package=name)
+        except ImportError as e:
+            if e.name != name + '.' + attr:
+                raise
+            raise AttributeError("module %r has no attribute %r" % (name, attr))
+
+    def __dir__():
+        import pkgutil
+        submodules = [m[1] for m in pkgutil.iter_modules(module.__path__)]
+        return sorted(set(list(module.__dict__.keys()) + submodules))
+
+    module.__getattr__ = __getattr__
+    module.__dir__ = __dir__
+    return
@@ -9,22 +9,948 @@ File Utils
 
 import os
 import sys
+import collections
+import errno
+import fnmatch
+import itertools
+import logging
+import shutil
+import stat
+import struct
+import threading
+import time
 from . import sequential
 
-ZIP_EXTENSIONS = ['bz2', 'gz', 'xz', 'bz2', 'rar', 'gz', 'tar', 'tbz2', 'tgz', 'zip', 'Z', '7z', 'xz', 'ace']
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+ZIP_EXTENSIONS = ['bz2', 'gz', 'xz', 'bz2', 'rar', 'gz', 'tar', 'tbz2', 'tgz', 'txz', 'zip', 'Z', '7z', 'xz', 'ace']
+
+VCS_FOLDERS = ['.svn', '.git', '.hg', '.bzr', 'CVS']
+
+
+class FileEntry(object):
+    """
+    File found by iter_files(), backed by an os.DirEntry : stat data is cached (and often obtained without any system call).
+    Can be used as a path (os.fspath).
+    """
+    __slots__ = ('entry', 'depth', 'follow_symlinks')
+
+    def __init__(self, entry, depth, follow_symlinks=False):
+        self.entry = entry
+        self.depth = depth
+        self.follow_symlinks = follow_symlinks
+
+    @property
+    def path(self):
+        return self.entry.path
+
+    @property
+    def name(self):
+        return self.entry.name
+
+    def stat(self):
+        return self.entry.stat(follow_symlinks=self.follow_symlinks)
+
+    @property
+    def size(self):
+        return self.stat().st_size
+
+    @property
+    def mtime(self):
+        return self.stat().st_mtime
+
+    @property
+    def inode(self):
+        return self.entry.inode()
+
+    def is_symlink(self):
+        return self.entry.is_symlink()
+
+    def __fspath__(self):
+        return self.entry.path
+
+    def __str__(self):
+        return self.entry.path
+
+    def __repr__(self):
+        return "<FileEntry %r>" % self.entry.path
+
+
+def _match_any(name, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
+
+
+def _as_pattern_list(patterns):
+    if patterns is None:
+        return []
+    if isinstance(patterns, str):
+        return [patterns]
+    return list(patterns)
+
+
+def _iter_folder(folder, depth, exclude_dirs, include_glob, follow_symlinks, max_depth, sort, onerror, visit, dir_links=False):
+    """
+    Lists one folder for the file walkers.
+    Yields (False, FileEntry) for each file and (True, path) for each subfolder to scan.
+    If dir_links is set (and follow_symlinks is not), symbolic links to folders are yielded as files.
+    """
+    try:
+        scandir_it = os.scandir(folder)
+    except OSError as e:
+        if onerror:
+            onerror(e)
+        return
+
+    with scandir_it:
+        entries = sorted(scandir_it, key=lambda e: e.name) if sort else scandir_it
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                if exclude_dirs and _match_any(entry.name, exclude_dirs):
+                    continue
+                if not follow_symlinks and entry.is_symlink():
+                    if dir_links and not (include_glob and not _match_any(entry.name, include_glob)):
+                        yield False, FileEntry(entry, depth)
+                    continue
+                if follow_symlinks:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    if not visit((st.st_dev, st.st_ino)):
+                        continue
+                yield True, entry.path
+                continue
+            if include_glob and not _match_any(entry.name, include_glob):
+                continue
+            yield False, FileEntry(entry, depth, follow_symlinks=follow_symlinks)
+
+
+def _folder_visitor(path, follow_symlinks):
+    """
+    Returns a thread safe function telling if a folder (dev, inode) is seen for the first time (avoids symlink loops).
+    """
+    visited = set()
+    lock = threading.Lock()
+
+    def visit(key):
+        with lock:
+            if key in visited:
+                return False
+            visited.add(key)
+            return True
+
+    if follow_symlinks:
+        st = os.stat(path)
+        visit((st.st_dev, st.st_ino))
+    return visit
+
+
+def iter_files(path, exclude_dirs=VCS_FOLDERS, include_glob=None, follow_symlinks=False, max_depth=None, sort=False, onerror=None):
+    """
+    Generator yielding FileEntry objects for all files in a folder and its subfolders, using os.scandir.
+    Excluded folders are pruned before being listed. Nothing is accumulated in memory but the folders left to scan.
+
+    :param path:              folder to scan
+    :param exclude_dirs:      folder names (or glob patterns) not to scan, matched on the folder name only (defaults to VCS folders)
+    :param include_glob:      glob pattern (or list of patterns) the file names should match (all files if not set)
+    :param follow_symlinks:   if True, symbolic links to folders are scanned too (each folder is scanned once)
+    :param max_depth:         maximum depth of scanned subfolders (0 : only files directly in path)
+    :param sort:              if True, entries of each folder are scanned by name order
+    :param onerror:           function called with the OSError raised when a folder can not be listed (ignored if not set)
+    """
+    exclude_dirs = _as_pattern_list(exclude_dirs)
+    include_glob = _as_pattern_list(include_glob)
+    visit = _folder_visitor(path, follow_symlinks)
+
+    stack = [(os.path.abspath(path), 0)]
+    while stack:
+        (folder, depth) = stack.pop()
+        subfolders = []
+        for (is_folder, item) in _iter_folder(folder, depth, exclude_dirs, include_glob, follow_symlinks, max_depth, sort, onerror, visit):
+            if is_folder:
+                subfolders.append(item)
+            else:
+                yield item
+
+        # reversed, so that subfolders are popped from the stack in listing order
+        for subfolder in reversed(subfolders):
+            stack.append((subfolder, depth + 1))
+
+
+def iter_files_parallel(path, workers=8, ordered=False, exclude_dirs=VCS_FOLDERS, include_glob=None, follow_symlinks=False, max_depth=None, sort=False, onerror=None):
+    """
+    Same as iter_files(), but folders are listed concurrently by a pool of "workers" threads.
+    Useful on network filesystems (NFS, CIFS...) where listing a folder is mostly waiting for the server.
+
+    :param workers:    number of folders listed at the same time
+    :param ordered:    if True, files are yielded in the same order as iter_files() (folders are then prefetched in parallel),
+                       otherwise they are yielded as soon as their folder has been listed.
+    See iter_files() for the other parameters.
+    """
+    import concurrent.futures
+    exclude_dirs = _as_pattern_list(exclude_dirs)
+    include_glob = _as_pattern_list(include_glob)
+    visit = _folder_visitor(path, follow_symlinks)
+
+    def list_folder(folder, depth):
+        return list(_iter_folder(folder, depth, exclude_dirs, include_glob, follow_symlinks, max_depth, sort, onerror, visit))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        if ordered:
+            stack = [(executor.submit(list_folder, os.path.abspath(path), 0), 0)]
+            while stack:
+                (future, depth) = stack.pop()
+                subfolders = []
+                for (is_folder, item) in future.result():
+                    if is_folder:
+                        subfolders.append((executor.submit(list_folder, item, depth + 1), depth + 1))
+                    else:
+                        yield item
+                stack.extend(reversed(subfolders))
+        else:
+            pending = collections.deque([(os.path.abspath(path), 0)])
+            running = {}
+            while pending or running:
+                # only a few folders are submitted at once, so that pending ones stay in a compact deque
+                while pending and len(running) < workers * 2:
+                    (folder, depth) = pending.popleft()
+                    running[executor.submit(list_folder, folder, depth)] = depth
+                (done, not_done) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    depth = running.pop(future)
+                    for (is_folder, item) in future.result():
+                        if is_folder:
+                            pending.append((item, depth + 1))
+                        else:
+                            yield item
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def full_file_list(scan_path):
     """
     Returns a list of all files in a folder and its subfolders (only files).
+    VCS folders (.git, .svn...) are skipped. See iter_files() to scan without building a list.
     """
-    file_list = []
-    path = os.path.abspath(scan_path)
-    for root, dirs, files in os.walk(path):
-        if len(files) != 0 and not '.svn' in root and not '.git' in root:
-            for f in files:
-                file_list.append(os.path.join(root, f))
-    return file_list
+    return [f.path for f in iter_files(scan_path)]
+
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+__hash_buffers = threading.local()
+
+
+def _new_hash(algo):
+    """
+    Returns a new hash object. "xxhash" (xxh3 64 bits, non cryptographic but much faster) requires the xxhash package.
+    """
+    if algo == 'xxhash':
+        if xxhash is None:
+            raise ImportError("xxhash hashing requires the xxhash library.")
+        return xxhash.xxh3_64()
+    import hashlib
+    return hashlib.new(algo)
+
+
+def _hash_file(path, algo='sha256', chunk_size=_HASH_CHUNK_SIZE, limit=None):
+    """
+    Hashes a file by chunks read into a buffer reused by the calling thread.
+    Only the first "limit" bytes are hashed if limit is set.
+    """
+    buffer = getattr(__hash_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != chunk_size:
+        buffer = __hash_buffers.buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    h = _new_hash(algo)
+    remaining = limit
+    with open(path, 'rb', buffering=0) as f:
+        while remaining is None or remaining > 0:
+            size = f.readinto(view if remaining is None or remaining >= chunk_size else view[:remaining])
+            if not size:
+                break
+            # hashlib releases the GIL on big buffers : threads hash in parallel
+            h.update(view[:size])
+            if remaining is not None:
+                remaining -= size
+    return h.hexdigest()
+
+
+def hash_files(paths, algo='sha256', workers=4, chunk_size=_HASH_CHUNK_SIZE, limit=None, onerror=None):
+    """
+    Hashes files with a pool of threads, yields (path, hex digest) tuples as soon as they are computed
+    (not in the order of paths).
+
+    :param paths:       iterable of file paths (or FileEntry objects), consumed lazily
+    :param algo:        any hashlib algorithm ('sha256', 'md5', 'blake2b'...) or 'xxhash' (requires the xxhash package)
+    :param workers:     number of hashing threads
+    :param chunk_size:  size of the chunks read
+    :param limit:       only hash the first "limit" bytes of each file (quick partial hashes)
+    :param onerror:     optional function called with the OSError raised for a file (which is then skipped),
+                        errors are raised otherwise
+    """
+    import concurrent.futures
+    _new_hash(algo)  # fail early on unknown algorithms
+    pending = set()
+    paths = iter(paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                # keep a bounded number of submitted files : paths may be a huge lazy iterator
+                for path in itertools.islice(paths, workers * 4 - len(pending)):
+                    path = os.fspath(path)
+                    future = executor.submit(_hash_file, path, algo, chunk_size, limit)
+                    future.path = path
+                    pending.add(future)
+                if not pending:
+                    break
+                (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        yield future.path, future.result()
+                    except OSError as e:
+                        if not onerror:
+                            raise
+                        onerror(e)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def find_duplicates(paths, algo='sha256', workers=4, partial_size=64 * 1024, onerror=None):
+    """
+    Finds files with the same content. Files are grouped by size first, then by the hash of their first
+    "partial_size" bytes, and only the remaining candidates are fully hashed.
+    Returns a list of lists of paths (each with at least two files).
+
+    :param paths:           iterable of file paths (or FileEntry objects, which often have their size without any system call)
+    :param algo:            see hash_files
+    :param workers:         number of hashing threads
+    :param partial_size:    size of the first pass partial hashes
+    :param onerror:         see hash_files
+    """
+    by_size = collections.defaultdict(list)
+    for path in paths:
+        try:
+            size = path.size if isinstance(path, FileEntry) else os.stat(path).st_size
+        except OSError as e:
+            if not onerror:
+                raise
+            onerror(e)
+            continue
+        by_size[size].append(os.fspath(path))
+
+    duplicates = []
+    candidates = []
+    for (size, group) in by_size.items():
+        if len(group) < 2:
+            continue
+        if size == 0:
+            duplicates.append(group)
+        else:
+            candidates.append((size, group))
+
+    def regroup(groups, limit=None):
+        """
+        Splits each group by hash (of the first "limit" bytes), keeps the groups of at least two files.
+        """
+        keys = {}
+        for (key, group) in groups:
+            for path in group:
+                keys[path] = key
+        by_hash = collections.defaultdict(list)
+        for (path, digest) in hash_files(keys, algo=algo, workers=workers, limit=limit, onerror=onerror):
+            by_hash[(keys[path], digest)].append(path)
+        return [(key, group) for (key, group) in by_hash.items() if len(group) > 1]
+
+    if partial_size:
+        # files smaller than partial_size are fully hashed by the first pass
+        candidates = regroup(candidates, limit=partial_size)
+        complete = [group for ((size, digest), group) in candidates if size <= partial_size]
+        duplicates += complete
+        candidates = [(key, group) for (key, group) in candidates if key[0] > partial_size]
+    duplicates += [group for (key, group) in regroup(candidates)]
+    return [sorted(group) for group in duplicates]
+
+
+class FileIndex(object):
+    """
+    Persistent index of the files of a folder (path, size, mtime, inode and optionally content hash),
+    stored in a SQLite database, to detect changes between successive scans without reprocessing everything.
+
+    :Usage:
+     >>> with FileIndex('/var/lib/ingest/watch.db', '/data/watch') as index:
+            changes = index.scan()
+            for path in changes['added'] + changes['modified']:
+                ingest(path)
+
+    :param db_path:              SQLite database file (':memory:' for a non persistent index)
+    :param root:                 folder to index
+    :param hash_algo:            if set (i.e. 'sha256'), content hash of added and modified files is computed and stored
+    :param exclude_dirs:         see iter_files
+    :param include_glob:         see iter_files
+    :param trust_folder_mtime:   if True, folders whose mtime did not change since last scan are not listed again.
+                                 A folder mtime changes when files are created, deleted or renamed in it,
+                                 but not when a file is modified in place : set it to False to detect in place modifications.
+    """
+
+    def __init__(self, db_path, root, hash_algo=None, exclude_dirs=VCS_FOLDERS, include_glob=None, trust_folder_mtime=True):
+        self.db_path = db_path
+        self.root = os.path.abspath(root)
+        self.hash_algo = hash_algo
+        self.exclude_dirs = _as_pattern_list(exclude_dirs)
+        self.include_glob = _as_pattern_list(include_glob)
+        self.trust_folder_mtime = trust_folder_mtime
+        import sqlite3
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, folder TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT);
+            CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER);
+            CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, path):
+        """
+        Returns the indexed information of a file as a dict (None if not indexed).
+        """
+        row = self.db.execute("SELECT path, size, mtime_ns, inode, hash FROM files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return self._file_dict(row) if row else None
+
+    def files(self):
+        """
+        Iterates over all indexed files (as dicts).
+        """
+        for row in self.db.execute("SELECT path, size, mtime_ns, inode, hash FROM files ORDER BY path"):
+            yield self._file_dict(row)
+
+    @staticmethod
+    def _file_dict(row):
+        return {'path': row[0], 'size': row[1], 'mtime': row[2] / 1e9, 'inode': row[3], 'hash': row[4]}
+
+    def _remove_folder(self, folder, changes):
+        """
+        Removes a folder and all its content from the index.
+        """
+        (low, high) = (folder + os.sep, folder + chr(ord(os.sep) + 1))
+        condition = "(path = ? OR (path >= ? AND path < ?))"
+        changes['removed'].extend([r[0] for r in self.db.execute(
+            "SELECT path FROM files WHERE (folder = ? OR (folder >= ? AND folder < ?))", (folder, low, high))])
+        self.db.execute("DELETE FROM files WHERE (folder = ? OR (folder >= ? AND folder < ?))", (folder, low, high))
+        self.db.execute("DELETE FROM folders WHERE " + condition, (folder, low, high))
+
+    def _scan_folder(self, folder, changes):
+        """
+        Lists a folder and updates the index. Returns its subfolders, or None if the folder could not be listed
+        (its index content is then left untouched).
+        """
+        known = dict([(r[0], r[1:]) for r in self.db.execute(
+            "SELECT path, size, mtime_ns, inode FROM files WHERE folder = ?", (folder,))])
+        subfolders = []
+        errors = []
+        for (is_folder, item) in _iter_folder(folder, 0, self.exclude_dirs, self.include_glob, False, None, False, errors.append, lambda key: True):
+            if is_folder:
+                subfolders.append(item)
+                continue
+            try:
+                st = item.stat()
+            except OSError:
+                continue
+            info = (st.st_size, st.st_mtime_ns, st.st_ino)
+            previous = known.pop(item.path, None)
+            if previous is not None and tuple(previous) == info:
+                continue
+            changes['added' if previous is None else 'modified'].append(item.path)
+            file_hash = None
+            if self.hash_algo:
+                try:
+                    file_hash = _hash_file(item.path, self.hash_algo)
+                except OSError:
+                    pass
+            self.db.execute("INSERT OR REPLACE INTO files (path, folder, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                            (item.path, folder) + info + (file_hash,))
+        if errors:
+            # the listing failed before anything was yielded : it must not be mistaken for an empty folder
+            logging.warning("Impossible to list %s, its index content is kept as is (%s)." % (folder, errors[0]))
+            return None
+        for path in known:
+            changes['removed'].append(path)
+            self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+        # folders removed since last scan
+        for (path,) in self.db.execute("SELECT path FROM folders WHERE parent = ?", (folder,)).fetchall():
+            if path not in subfolders:
+                self._remove_folder(path, changes)
+        return subfolders
+
+    def scan(self):
+        """
+        Scans the root folder and updates the index.
+        Folders that cannot be listed (i.e. permission denied) are skipped with a warning : their files and subfolders
+        stay in the index unchanged.
+
+        :returns:   {'added': [paths], 'removed': [paths], 'modified': [paths]}
+        """
+        changes = {'added': [], 'removed': [], 'modified': []}
+        stack = [(self.root, None)]
+        with self.db:
+            while stack:
+                (folder, parent) = stack.pop()
+                try:
+                    folder_mtime_ns = os.stat(folder).st_mtime_ns
+                except OSError:
+                    self._remove_folder(folder, changes)
+                    continue
+                row = self.db.execute("SELECT mtime_ns FROM folders WHERE path = ?", (folder,)).fetchone()
+                if self.trust_folder_mtime and row and row[0] == folder_mtime_ns:
+                    subfolders = [r[0] for r in self.db.execute("SELECT path FROM folders WHERE parent = ?", (folder,))]
+                else:
+                    subfolders = self._scan_folder(folder, changes)
+                    if subfolders is None:
+                        continue  # stored mtime not updated, so that the folder is listed again next time
+                    self.db.execute("INSERT OR REPLACE INTO folders (path, parent, mtime_ns) VALUES (?, ?, ?)",
+                                    (folder, parent, folder_mtime_ns))
+                stack.extend([(subfolder, folder) for subfolder in subfolders])
+        return changes
+
+
+FILE_CREATED = 'created'
+FILE_MODIFIED = 'modified'
+FILE_DELETED = 'deleted'
+FILE_MOVED = 'moved'
+
+
+class FileEvent(object):
+    """
+    File system event yielded by watch().
+
+    :param type:        FILE_CREATED, FILE_MODIFIED, FILE_DELETED or FILE_MOVED
+    :param path:        path of the file (source path for moves)
+    :param dest_path:   destination path for moves
+    :param is_dir:      True if the event is about a folder
+    :param completed:   True when the file has been closed after being written (or its size and mtime are stable),
+                        i.e. it is ready to be processed
+    """
+    __slots__ = ('type', 'path', 'dest_path', 'is_dir', 'completed')
+
+    def __init__(self, type, path, dest_path=None, is_dir=False, completed=False):
+        self.type = type
+        self.path = path
+        self.dest_path = dest_path
+        self.is_dir = is_dir
+        self.completed = completed
+
+    def __repr__(self):
+        return "<FileEvent %s %r%s%s%s>" % (self.type, self.path, ' -> %r' % self.dest_path if self.dest_path else '',
+                                            ' (dir)' if self.is_dir else '', ' (completed)' if self.completed else '')
+
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class _EventCoalescer(object):
+    """
+    Merges the raw events of each path until it has been quiet for "debounce" seconds.
+    Files registered with check_stability() are reported as completed once their size and mtime
+    did not change for "settle" seconds.
+    """
+
+    def __init__(self, debounce, settle):
+        self.debounce = debounce
+        self.settle = settle
+        self.events = collections.OrderedDict()
+        self.last_change = {}
+        self.unstable = {}
+
+    def add(self, kind, path, is_dir=False, dest_path=None):
+        """
+        kind is FILE_CREATED, FILE_MODIFIED, FILE_DELETED, FILE_MOVED or 'closed' (file closed after writing).
+        """
+        event = self.events.get(path, None)
+        if kind == FILE_MOVED:
+            self.events.pop(path, None)
+            self.events[dest_path] = FileEvent(FILE_MOVED, path, dest_path=dest_path, is_dir=is_dir,
+                                               completed=bool(event and event.completed) or event is None)
+            self.last_change[dest_path] = time.monotonic()
+            self.unstable.pop(path, None)
+            return
+        if kind == FILE_DELETED:
+            self.unstable.pop(path, None)
+            if event and event.type == FILE_CREATED:
+                # created and deleted in the same window : nothing happened
+                del self.events[path]
+                return
+            event = self.events[path] = FileEvent(FILE_DELETED, path, is_dir=is_dir)
+        elif event is None or event.type == FILE_DELETED:
+            event = self.events[path] = FileEvent(FILE_CREATED if kind == FILE_CREATED or (event and kind != 'closed') else FILE_MODIFIED,
+                                                  path, is_dir=is_dir)
+        if kind == 'closed':
+            event.completed = True
+        elif kind == FILE_MODIFIED:
+            event.completed = False
+        self.events.move_to_end(path)
+        self.last_change[path] = time.monotonic()
+
+    def check_stability(self, path):
+        self.unstable[path] = (_stat_signature(path), time.monotonic() + self.settle)
+
+    def _check_unstable(self, now):
+        for (path, (signature, check_time)) in list(self.unstable.items()):
+            if check_time > now:
+                continue
+            current = _stat_signature(path)
+            if current is None:
+                del self.unstable[path]
+            elif current == signature:
+                del self.unstable[path]
+                self.add('closed', path)
+            else:
+                self.unstable[path] = (current, now + self.settle)
+
+    def flush(self, force=False):
+        """
+        Returns the events of paths that have been quiet for "debounce" seconds (all of them if force is True),
+        except the paths waiting for their size and mtime to settle.
+        """
+        now = time.monotonic()
+        self._check_unstable(now)
+        ready = []
+        for (path, event) in list(self.events.items()):
+            if not force and path in self.unstable:
+                # yielded once the file is complete (or deleted), as a single event
+                continue
+            if force or now - self.last_change.get(path, 0) >= self.debounce:
+                ready.append(event)
+                del self.events[path]
+                self.last_change.pop(path, None)
+        return ready
+
+    def next_timeout(self):
+        """
+        Returns the time to wait before the next event may be ready (None if there is nothing pending).
+        """
+        now = time.monotonic()
+        deadlines = [self.last_change[path] + self.debounce for path in self.events
+                     if path in self.last_change and path not in self.unstable]
+        deadlines += [check_time for (signature, check_time) in self.unstable.values()]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - now, 0)
+
+
+# inotify constants (see linux/inotify.h)
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_WATCH_MASK = (_IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE |
+                  _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR)
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class _Inotify(object):
+    """
+    Minimal ctypes binding of Linux inotify.
+    """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.paths = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), _IN_WATCH_MASK)
+        if wd < 0:
+            import ctypes
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.paths[wd] = path
+        return wd
+
+    def rename_folder(self, path, dest_path):
+        for (wd, watched) in list(self.paths.items()):
+            if watched == path or watched.startswith(path + os.sep):
+                self.paths[wd] = dest_path + watched[len(path):]
+
+    def read(self):
+        """
+        Returns the pending events as (mask, cookie, path) tuples.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = _INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + _INOTIFY_EVENT.size:offset + _INOTIFY_EVENT.size + length].rstrip(b'\0')
+            offset += _INOTIFY_EVENT.size + length
+            folder = self.paths.get(wd, None)
+            if mask & _IN_IGNORED:
+                self.paths.pop(wd, None)
+            if folder is None and not mask & _IN_Q_OVERFLOW:
+                continue
+            events.append((mask, cookie, os.path.join(folder, os.fsdecode(name)) if name else folder))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _watch_inotify(path, recursive, coalescer, exclude_dirs, include_glob, stop_event, wake_interval):
+    """
+    Starts watching a folder with inotify and returns the events generator.
+    Raises OSError (or AttributeError when the libc has no inotify functions) if inotify cannot be used or the folder
+    cannot be watched, before any event is yielded.
+    """
+    inotify = _Inotify()
+    try:
+        inotify.add_watch(path)
+    except OSError:
+        inotify.close()
+        raise
+    return _iter_inotify_events(inotify, path, recursive, coalescer, exclude_dirs, include_glob, stop_event, wake_interval)
+
+
+def _iter_inotify_events(inotify, path, recursive, coalescer, exclude_dirs, include_glob, stop_event, wake_interval):
+    import selectors
+
+    def add_folder(folder, report_content=False, is_root=False):
+        """
+        Watches a folder (unless it is the root folder, already watched) and its subfolders if recursive.
+        Subfolders and files already in the folder are reported if report_content is set (new folders).
+        Failures (i.e. ENOSPC once fs.inotify.max_user_watches is reached, or a folder already deleted) are logged.
+        """
+        folders = [] if is_root else [folder]
+        if recursive:
+            for (is_folder, item) in _iter_folder_tree(folder, exclude_dirs, include_glob, report_content):
+                if is_folder:
+                    folders.append(item)
+                    if report_content:
+                        coalescer.add(FILE_CREATED, item, is_dir=True)
+                else:
+                    # the file may have been written before the folder was watched : completed once stable
+                    coalescer.add(FILE_CREATED, item.path)
+                    coalescer.check_stability(item.path)
+        errors = []
+        for f in folders:
+            try:
+                inotify.add_watch(f)
+            except OSError as e:
+                errors.append(e)
+        if errors:
+            logging.warning("Impossible to watch %d folder(s) under %s, their changes will be missed (first error : %s)."
+                            % (len(errors), folder, errors[0]))
+
+    def included(event_path, is_dir):
+        if is_dir:
+            return not (exclude_dirs and _match_any(os.path.basename(event_path), exclude_dirs))
+        return not include_glob or _match_any(os.path.basename(event_path), include_glob)
+
+    try:
+        add_folder(path, is_root=True)
+        with selectors.DefaultSelector() as selector:
+            selector.register(inotify.fd, selectors.EVENT_READ)
+            while not (stop_event and stop_event.is_set()):
+                timeout = coalescer.next_timeout()
+                timeout = wake_interval if timeout is None else min(timeout, wake_interval)
+                if selector.select(timeout):
+                    moved_from = {}
+                    for (mask, cookie, event_path) in inotify.read():
+                        is_dir = bool(mask & _IN_ISDIR)
+                        if mask & _IN_Q_OVERFLOW:
+                            logging.warning("inotify queue overflow while watching %s, some events were lost." % path)
+                            continue
+                        if mask & (_IN_DELETE_SELF | _IN_MOVE_SELF | _IN_IGNORED) or not included(event_path, is_dir):
+                            continue
+                        if mask & _IN_MOVED_FROM:
+                            moved_from[cookie] = (event_path, is_dir)
+                        elif mask & _IN_MOVED_TO:
+                            if cookie in moved_from:
+                                (source, source_is_dir) = moved_from.pop(cookie)
+                                coalescer.add(FILE_MOVED, source, is_dir=is_dir, dest_path=event_path)
+                                if is_dir:
+                                    inotify.rename_folder(source, event_path)
+                            else:
+                                # moved in from outside of the watched folder
+                                coalescer.add(FILE_CREATED, event_path, is_dir=is_dir)
+                                if is_dir and recursive:
+                                    add_folder(event_path, report_content=True)
+                                elif not is_dir:
+                                    coalescer.add('closed', event_path)
+                        elif mask & _IN_CREATE:
+                            coalescer.add(FILE_CREATED, event_path, is_dir=is_dir)
+                            if is_dir and recursive:
+                                add_folder(event_path, report_content=True)
+                        elif mask & _IN_DELETE:
+                            coalescer.add(FILE_DELETED, event_path, is_dir=is_dir)
+                        elif mask & _IN_MODIFY and not is_dir:
+                            coalescer.add(FILE_MODIFIED, event_path)
+                        elif mask & _IN_CLOSE_WRITE and not is_dir:
+                            coalescer.add('closed', event_path)
+                    # moved out of the watched folder
+                    for (source, source_is_dir) in moved_from.values():
+                        coalescer.add(FILE_DELETED, source, is_dir=source_is_dir)
+                for event in coalescer.flush():
+                    yield event
+    finally:
+        inotify.close()
+
+
+def _iter_folder_tree(folder, exclude_dirs, include_glob, with_files=True, dir_links=False):
+    """
+    Yields (True, path) for all subfolders of a folder, and (False, FileEntry) for its files if with_files is True.
+    Symbolic links to folders are not followed, they are yielded as files if dir_links is True.
+    """
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        for (is_folder, item) in _iter_folder(current, 0, exclude_dirs, include_glob, False, None, False, None, lambda key: True,
+                                              dir_links=dir_links):
+            if is_folder:
+                stack.append(item)
+                yield True, item
+            elif with_files:
+                yield False, item
+
+
+def _watch_polling(path, recursive, coalescer, exclude_dirs, include_glob, stop_event, poll_interval):
+    def snapshot():
+        """
+        Returns {path: (size, mtime_ns, inode)} for files and {path: (None, None, inode)} for folders,
+        a folder is listed before its content.
+        """
+        result = {}
+        stack = [path]
+        while stack:
+            folder = stack.pop()
+            for (is_folder, item) in _iter_folder(folder, 0, exclude_dirs, include_glob, False, None, False, None, lambda key: True):
+                try:
+                    st = os.stat(item) if is_folder else item.stat()
+                except OSError:
+                    continue
+                if is_folder:
+                    result[item] = (None, None, st.st_ino)
+                    if recursive:
+                        stack.append(item)
+                else:
+                    result[item.path] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        return result
+
+    previous = snapshot()
+    next_poll = time.monotonic() + poll_interval
+    while not (stop_event and stop_event.is_set()):
+        timeout = coalescer.next_timeout()
+        wait = max(next_poll - time.monotonic(), 0)
+        time.sleep(wait if timeout is None else min(timeout, wait))
+        if time.monotonic() >= next_poll:
+            next_poll = time.monotonic() + poll_interval
+            current = snapshot()
+            # a removed path and a new path sharing the same inode and size is a move
+            removed = {previous[file_path]: file_path for file_path in previous if file_path not in current}
+            moved_folders = []
+            for (file_path, info) in current.items():
+                is_dir = info[0] is None
+                if file_path not in previous:
+                    source = removed.pop(info, None)
+                    if source is not None:
+                        # the content of a moved folder is not reported (like inotify does)
+                        if not any(source.startswith(folder + os.sep) and file_path == dest + source[len(folder):]
+                                   for (folder, dest) in moved_folders):
+                            coalescer.add(FILE_MOVED, source, is_dir=is_dir, dest_path=file_path)
+                        if is_dir:
+                            moved_folders.append((source, file_path))
+                        continue
+                    coalescer.add(FILE_CREATED, file_path, is_dir=is_dir)
+                    if not is_dir:
+                        coalescer.check_stability(file_path)
+                elif previous[file_path] != info and not is_dir:
+                    coalescer.add(FILE_MODIFIED, file_path)
+                    coalescer.check_stability(file_path)
+            for (info, file_path) in removed.items():
+                coalescer.add(FILE_DELETED, file_path, is_dir=info[0] is None)
+            previous = current
+        for event in coalescer.flush():
+            yield event
+
+
+def watch(path, recursive=True, debounce=0.5, settle=2.0, exclude_dirs=VCS_FOLDERS, include_glob=None, use_inotify=True, poll_interval=1.0, stop_event=None):
+    """
+    Watches a folder and yields FileEvent objects (created, modified, moved, deleted files and folders).
+    Uses Linux inotify when available (no polling), otherwise scans the folder every "poll_interval" seconds.
+
+    Events are coalesced per path : an event is yielded once its path has been quiet for "debounce" seconds
+    (i.e. a file created, written and closed gives one created event with completed=True).
+    A file is considered completed when it has been closed after writing (inotify), or when its size and mtime did not
+    change for "settle" seconds (polling, or files already in a folder moved or created in the watched folder).
+    Processing hot folders should rely on events with completed=True.
+
+    :param path:            folder to watch
+    :param recursive:       if True, subfolders are watched too (including new ones)
+    :param debounce:        quiet time (seconds) before the events of a path are yielded
+    :param settle:          time (seconds) a file size and mtime should stay unchanged to be considered completed
+    :param exclude_dirs:    see iter_files
+    :param include_glob:    see iter_files
+    :param use_inotify:     set to False to force polling
+    :param poll_interval:   time between scans in polling mode
+    :param stop_event:      a threading.Event to stop watching (checked at least every poll_interval seconds),
+                            closing the generator works too
+    """
+    path = os.path.abspath(path)
+    exclude_dirs = _as_pattern_list(exclude_dirs)
+    include_glob = _as_pattern_list(include_glob)
+    coalescer = _EventCoalescer(debounce, settle)
+    events = None
+    if use_inotify and sys.platform.startswith('linux'):
+        try:
+            events = _watch_inotify(path, recursive, coalescer, exclude_dirs, include_glob, stop_event, poll_interval)
+        except (OSError, AttributeError) as e:
+            logging.warning("Impossible to watch %s with inotify (%s), polling instead." % (path, e))
+    if events is None:
+        events = _watch_polling(path, recursive, coalescer, exclude_dirs, include_glob, stop_event, poll_interval)
+    for event in events:
+        yield event
 
 
 def list_files(scan_path, contains=None):
@@ -42,26 +968,70 @@ def list_files(scan_path, contains=None):
     return file_list
 
 
+def iter_files_with_sequences(path, exclude_dirs=VCS_FOLDERS, include_glob=None, min_sequence_length=2, follow_symlinks=False, max_depth=None, onerror=None):
+    """
+    Generator yielding the file sequences (sequential.FileSequence objects, possibly with missing frames) and the other
+    files (paths) of a folder and its subfolders. Each folder is listed once (os.scandir) and may hold several sequences
+    plus loose files. Sequences of a folder are yielded before its loose files.
+
+    :param min_sequence_length: minimum number of files of a sequence
+    Other parameters : see iter_files.
+    """
+    exclude_dirs = _as_pattern_list(exclude_dirs)
+    include_glob = _as_pattern_list(include_glob)
+    visit = _folder_visitor(path, follow_symlinks)
+
+    stack = [(os.path.abspath(path), 0)]
+    while stack:
+        (folder, depth) = stack.pop()
+        subfolders = []
+        files = []
+        for (is_folder, item) in _iter_folder(folder, depth, exclude_dirs, include_glob, follow_symlinks, max_depth, True, onerror, visit):
+            if is_folder:
+                subfolders.append(item)
+            else:
+                files.append(item.path)
+
+        if files:
+            (sequences, loose_files) = sequential.group_files(files, min_length=min_sequence_length)
+            for sequence in sequences:
+                yield sequence
+            for f in loose_files:
+                yield f
+
+        for subfolder in reversed(subfolders):
+            stack.append((subfolder, depth + 1))
+
+
 def full_file_list_with_sequence(scan_path):
     """
     Returns a list of all files in a folder and its subfolders (only files).
+    A folder whose files form a sequence is given as a sequential.SequentialFolder object instead of its files.
+    Each folder is listed once. See iter_files_with_sequences() to find several sequences per folder, with missing frames.
     """
-    
     file_list = []
-    path = os.path.abspath(scan_path)
-    
-    for root, dirs, files in os.walk(path):
-        if len(files) != 0 and not '.svn' in root and not '.git' in root:
-            try:
-                sc = sequential.SequentialFolder(str(root))
-                if sc.sequence:
-                    file_list.append(sc)
-                    continue
-            except Exception as e:
-                pass
-                
-            for f in files:
-                file_list.append(os.path.join(root, f))
+    stack = [os.path.abspath(scan_path)]
+    while stack:
+        folder = stack.pop()
+        subfolders = []
+        files = []
+        for (is_folder, item) in _iter_folder(folder, 0, VCS_FOLDERS, None, False, None, False, None, lambda key: True):
+            if is_folder:
+                subfolders.append(item)
+            else:
+                files.append(item.path)
+        stack.extend(reversed(subfolders))
+        if not files:
+            continue
+        try:
+            # hidden files are not part of sequences (a folder glob skips them)
+            sc = sequential.SequentialFolder(folder, [f for f in files if not os.path.basename(f).startswith('.')])
+            if sc.sequence:
+                file_list.append(sc)
+                continue
+        except Exception:
+            pass
+        file_list.extend(files)
     return file_list
 
 
@@ -77,76 +1047,518 @@ def readlinkabs(l):
     return os.path.abspath(os.path.join(os.path.dirname(l), p))
 
 
-def unzip(filepath, output_path):
+class UnsafeArchiveError(Exception):
     """
-    Unzip an archive file
+    Raised when an archive member would be extracted outside of the output folder.
     """
-    filename = os.path.split(filepath)[1]
+    pass
+
+
+# archive formats that no standard module reads : extracted with external tools (no shell involved)
+EXTERNAL_EXTRACTORS = {
+    'rar': lambda filepath, output_path: ['unrar', 'x', '-o+', filepath, output_path + os.sep],
+    '7z': lambda filepath, output_path: ['7z', 'x', '-y', '-o' + output_path, filepath],
+    'iso': lambda filepath, output_path: ['7z', 'x', '-y', '-o' + output_path, filepath],
+    'arj': lambda filepath, output_path: ['7z', 'x', '-y', '-o' + output_path, filepath],
+    'ace': lambda filepath, output_path: ['unace', 'x', '-y', filepath, output_path + os.sep],
+}
+
+_EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+
+def _is_inside(output_path, path):
+    return path == output_path or path.startswith(output_path + os.sep)
+
+
+def _safe_join(output_path, member_name):
+    """
+    Returns the path of an archive member in the output folder (its parent folder resolved), raises UnsafeArchiveError
+    on path traversal (absolute names, drive letters, "..", symbolic links pointing outside of the output folder).
+    """
+    name = member_name.replace('\\', '/')
+    parts = [p for p in name.split('/') if p and p != '.']
+    if name.startswith('/') or os.path.splitdrive(name)[0] or '..' in parts:
+        raise UnsafeArchiveError("Archive member %s would be extracted outside of %s" % (member_name, output_path))
+    if not parts:
+        return output_path
+    target = os.path.join(os.path.realpath(os.path.join(output_path, *parts[:-1])), parts[-1])
+    if not _is_inside(output_path, os.path.dirname(target)) or not _is_inside(output_path, os.path.realpath(target)):
+        raise UnsafeArchiveError("Archive member %s would be extracted outside of %s" % (member_name, output_path))
+    return target
+
+
+class _ProgressCounter(object):
+    """
+    Thread safe byte counter calling progress(done_bytes, total_bytes, member_name).
+    """
+
+    def __init__(self, callback, total):
+        self.callback = callback
+        self.total = total
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def update(self, size, name):
+        if not self.callback:
+            return
+        with self.lock:
+            self.done += size
+            done = self.done
+        self.callback(done, self.total, name)
+
+
+def _copy_stream(source, target_path, progress, name, chunk_size, mode=None):
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(target_path, 'wb') as target:
+        while True:
+            size = source.readinto(buffer)
+            if not size:
+                break
+            target.write(view[:size])
+            progress.update(size, name)
+    if mode:
+        os.chmod(target_path, mode & 0o777)
+
+
+def _extract_zip(filepath, output_path, workers, progress, chunk_size):
+    import concurrent.futures
+    import zipfile
+    with zipfile.ZipFile(filepath) as archive:
+        members = archive.infolist()
+    targets = [(member, _safe_join(output_path, member.filename)) for member in members]
+    progress.total = sum(member.file_size for member in members)
+
+    files = []
+    for (member, target) in targets:
+        if member.is_dir():
+            os.makedirs(target, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            files.append((member, target))
+
+    # each thread reads the archive through its own file handle
+    local = threading.local()
+    archives = []
+
+    def extract_member(member, target):
+        archive = getattr(local, 'archive', None)
+        if archive is None:
+            archive = local.archive = zipfile.ZipFile(filepath)
+            archives.append(archive)
+        mode = member.external_attr >> 16 if member.create_system == 3 else None
+        with archive.open(member) as source:
+            _copy_stream(source, target, progress, member.filename, chunk_size, mode=mode)
+        mtime = time.mktime(member.date_time + (0, 0, -1))
+        os.utime(target, (mtime, mtime))
+        return target
+
+    try:
+        # biggest members first, to balance the threads
+        files.sort(key=lambda item: item[0].file_size, reverse=True)
+        if workers and workers > 1 and len(files) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(lambda item: extract_member(*item), files))
+        return [extract_member(member, target) for (member, target) in files]
+    finally:
+        for archive in archives:
+            archive.close()
+
+
+def _extract_tar(filepath, output_path, progress, chunk_size):
+    import tarfile
+    extracted = []
+    symlinks = []
+    progress.total = None
+    # stream mode : members are read sequentially, compression (gz, bz2, xz) is detected
+    with tarfile.open(filepath, mode='r|*') as archive:
+        for member in archive:
+            target = _safe_join(output_path, member.name)
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if member.issym() or member.islnk():
+                # resolved from the real location of the link (folders extracted before may be symbolic links),
+                # hard link names are relative to the archive root
+                link_path = os.path.realpath(os.path.join(os.path.dirname(target) if member.issym() else output_path,
+                                                          member.linkname))
+                if os.path.isabs(member.linkname) or not _is_inside(output_path, link_path):
+                    raise UnsafeArchiveError("Archive link %s points outside of %s" % (member.name, output_path))
+                if os.path.lexists(target):
+                    os.remove(target)
+                if member.issym():
+                    os.symlink(member.linkname, target)
+                    symlinks.append((member.name, target))
+                else:
+                    os.link(link_path, target)
+                extracted.append(target)
+                continue
+            if not member.isfile():
+                # devices and fifos are skipped
+                continue
+            if os.path.islink(target):
+                os.remove(target)  # replaced, not written through
+            source = archive.extractfile(member)
+            _copy_stream(source, target, progress, member.name, chunk_size, mode=member.mode & 0o777)
+            os.utime(target, (member.mtime, member.mtime))
+            extracted.append(target)
+    # a link checked when it was created may point elsewhere once the links it goes through are extracted
+    # (i.e. "b -> a/.." then "a -> .")
+    escaping = [(name, link) for (name, link) in symlinks if not _is_inside(output_path, os.path.realpath(link))]
+    if escaping:
+        for (name, link) in escaping:
+            os.remove(link)
+        raise UnsafeArchiveError("Archive link %s points outside of %s" % (escaping[0][0], output_path))
+    return extracted
+
+
+def _extract_compressed_file(filepath, output_path, opener, progress, chunk_size):
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    target = _safe_join(output_path, name)
+    progress.total = None
+    with opener(filepath, 'rb') as source:
+        _copy_stream(source, target, progress, name, chunk_size)
+    return [target]
+
+
+def _archive_type(filepath):
+    filename = os.path.basename(filepath)
     (name, extension) = os.path.splitext(filename)
-    extension = extension[1:].lower()
+    extension = extension[1:].lower() if extension[1:] != 'Z' else 'Z'
     extension2 = os.path.splitext(name)[1][1:].lower()
+    if extension in ('tar', 'tgz', 'tbz2', 'txz') or (extension2 == 'tar' and extension in ('gz', 'bz2', 'xz')):
+        return 'tar'
+    return extension
+
 
-    if extension not in ZIP_EXTENSIONS:
+def extract(filepath, output_path, workers=4, progress=None, chunk_size=_EXTRACT_CHUNK_SIZE):
+    """
+    Extracts an archive file in process : zip, tar (.tar.gz/.tgz, .tar.bz2/.tbz2, .tar.xz/.txz), gz, bz2 and xz.
+    Data is streamed by chunks, zip members are extracted in parallel by "workers" threads.
+    Members that would land outside of the output folder, and links pointing outside of it, raise UnsafeArchiveError
+    (nothing is written for zip files).
+    rar, 7z, ace, iso, arj and Z archives are extracted with external tools (see EXTERNAL_EXTRACTORS).
+    Returns the list of extracted files (an empty list for external tools).
+
+    :param filepath:    archive file
+    :param output_path: folder to extract the archive to (created if needed)
+    :param workers:     number of threads extracting zip members
+    :param progress:    optional callback called with (done_bytes, total_bytes, member_name), total_bytes is None
+                        when the archive does not give it (tar streams, compressed files)
+    :param chunk_size:  size of the chunks read and written
+    """
+    import subprocess
+    archive_type = _archive_type(filepath)
+    if archive_type not in ZIP_EXTENSIONS and archive_type not in EXTERNAL_EXTRACTORS:
         raise Exception("Impossible to extract archive file %s" % filepath)
 
-    extract_command = "unzip"
-    output_args = "-d"
-    if extension == 'bz2' and extension2 == 'tar':
-        extract_command = "tar -xjf"
-        output_args = "-C"
-    elif extension == 'gz' and extension2 == 'tar':
-        extract_command = "tar -xzf"
-        output_args = "-C"
-    elif extension == 'xz' and extension2 == 'tar':
-        extract_command = "tar -xJf"
-        output_args = "-C"
-    elif extension == 'bz2':
-        extract_command = "bunzip2 -dc "
-        output_args = ">"
-        output_path = os.path.join(output_path, name)
-    elif extension == 'rar':
-        extract_command = "unrar x"
-        output_args = ""
-    elif extension == 'gz':
-        extract_command = "gunzip"
-        output_args = ""
-    elif extension == 'tar':
-        extract_command = "tar -xf"
-        output_args = "-C"
-    elif extension == 'tbz2':
-        extract_command = "tar -xjf"
-        output_args = "-C"
-    elif extension == 'tgz':
-        extract_command = "tar -xzf"
-        output_args = "-C"
-    elif extension == 'zip':
-        extract_command = "unzip"
-        output_args = "-d"
-    elif extension == 'Z':
-        extract_command = "uncompress"
-        output_args = ""
-    elif extension == '7z':
-        extract_command = "7z x"
-        output_args = ""
-    elif extension == 'xz':
-        extract_command = "unxz"
-        output_args = ""
-    elif extension == 'ace':
-        extract_command = "unace"
-        output_args = ""
-    elif extension == 'iso':
-        extract_command = "7z x"
-        output_args = ""
-    elif extension == 'arj':
-        extract_command = "7z x"
-        output_args = ""
-
-    command = """%(extract_command)s "%(filepath)s" %(output_args)s "%(output_folder)s" """
-    params = {
-        'extract_command': extract_command,
-        'filepath': filepath,
-        'output_folder': output_path,
-        'output_args': output_args,
-    }
-    result = os.system(command % params)
-    return result
\ No newline at end of file
+    output_path = os.path.realpath(output_path)
+    os.makedirs(output_path, exist_ok=True)
+    progress = _ProgressCounter(progress, None)
+
+    if archive_type == 'zip':
+        return _extract_zip(filepath, output_path, workers, progress, chunk_size)
+    if archive_type == 'tar':
+        return _extract_tar(filepath, output_path, progress, chunk_size)
+    if archive_type in ('gz', 'bz2', 'xz'):
+        import bz2
+        import gzip
+        import lzma
+        opener = {'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}[archive_type]
+        return _extract_compressed_file(filepath, output_path, opener, progress, chunk_size)
+
+    if archive_type == 'Z':
+        target = _safe_join(output_path, os.path.splitext(os.path.basename(filepath))[0])
+        with open(target, 'wb') as output:
+            subprocess.run(['uncompress', '-c', filepath], stdout=output, check=True)
+        return [target]
+    subprocess.run(EXTERNAL_EXTRACTORS[archive_type](filepath, output_path), stdout=subprocess.DEVNULL, check=True)
+    return []
+
+
+def unzip(filepath, output_path):
+    """
+    Unzip an archive file (see extract).
+    Returns 0 on success, the exit code of the external tool if it failed, 1 if the archive is corrupted or unsafe
+    (the error is logged). Unsupported archive types raise an exception.
+    """
+    import lzma
+    import subprocess
+    import tarfile
+    import zipfile
+    import zlib
+    try:
+        extract(filepath, output_path)
+    except subprocess.CalledProcessError as e:
+        return e.returncode
+    except (UnsafeArchiveError, zipfile.BadZipFile, tarfile.TarError, lzma.LZMAError, zlib.error, EOFError, OSError) as e:
+        logging.error("Impossible to extract archive file %s : %s" % (filepath, e))
+        return 1
+    return 0
+
+
+_COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _copy_range_userspace(src_fd, dst_fd, offset, count, progress, name):
+    buffer = bytearray(min(count, _COPY_CHUNK_SIZE))
+    view = memoryview(buffer)
+    while count > 0:
+        size = os.preadv(src_fd, [view[:min(count, len(buffer))]], offset)
+        if not size:
+            break
+        written = 0
+        while written < size:
+            written += os.pwrite(dst_fd, view[written:size], offset + written)
+        offset += size
+        count -= size
+        progress.update(size, name)
+    return offset
+
+
+def _copy_range(src_fd, dst_fd, offset, count, progress, name, method):
+    """
+    Copies "count" bytes at "offset" from src_fd to dst_fd (same offset), in the kernel when possible.
+    method is a list holding the current method, downgraded when the kernel or file system does not support it :
+    copy_file_range (no copy at all on CoW or network file systems), then sendfile, then read/write.
+    """
+    end = offset + count
+    while offset < end:
+        size = min(end - offset, _COPY_CHUNK_SIZE)
+        try:
+            if method[0] == 'copy_file_range':
+                copied = os.copy_file_range(src_fd, dst_fd, size, offset, offset)
+            elif method[0] == 'sendfile':
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copied = os.sendfile(dst_fd, src_fd, offset, size)
+            else:
+                return _copy_range_userspace(src_fd, dst_fd, offset, end - offset, progress, name)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM):
+                raise
+            method[0] = 'sendfile' if method[0] == 'copy_file_range' and hasattr(os, 'sendfile') else 'read'
+            continue
+        if not copied:
+            # source file shrunk
+            break
+        offset += copied
+        progress.update(copied, name)
+    return offset
+
+
+def _data_segments(fd, start, size):
+    """
+    Yields the (offset, length) data segments of a sparse file from "start", skipping holes.
+    """
+    offset = start
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole until the end of the file
+                return
+            raise
+        hole = os.lseek(fd, data, os.SEEK_HOLE)
+        yield data, min(hole, size) - data
+        offset = hole
+
+
+def copy(src, dst, progress=None, resume=False, preserve_sparse=True, preserve_metadata=True):
+    """
+    Copies a file without moving its data through Python buffers : os.copy_file_range is used (server side copies on
+    NFS/SMB, reflinks on CoW file systems), or os.sendfile, or a read/write loop as last resort.
+    Returns the destination path.
+
+    :param src:                 file to copy
+    :param dst:                 destination file or folder
+    :param progress:            optional callback called with (copied_bytes, total_bytes, src)
+    :param resume:              if True and dst is a partial copy (smaller than src), only the missing end is copied
+    :param preserve_sparse:     if True, holes of sparse files are not copied (nor allocated in dst)
+    :param preserve_metadata:   if True, permissions and times are copied too (shutil.copystat)
+
+    Raises shutil.SameFileError if src and dst are the same file, shutil.SpecialFileError if one of them is not
+    a regular file (i.e. a named pipe).
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if not isinstance(progress, _ProgressCounter):
+        progress = _ProgressCounter(progress, None)
+
+    # O_NONBLOCK : opening a named pipe must not block before it is rejected (no effect on regular files)
+    nonblock = getattr(os, 'O_NONBLOCK', 0)
+    src_fd = os.open(src, os.O_RDONLY | nonblock)
+    try:
+        st = os.fstat(src_fd)
+        if not stat.S_ISREG(st.st_mode):
+            raise shutil.SpecialFileError("%s is not a regular file" % src)
+        if progress.total is None:
+            progress.total = st.st_size
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | nonblock, st.st_mode & 0o777)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # named pipe without reader
+                raise shutil.SpecialFileError("%s is a named pipe" % dst)
+            raise
+        try:
+            dst_st = os.fstat(dst_fd)
+            if not stat.S_ISREG(dst_st.st_mode):
+                raise shutil.SpecialFileError("%s is not a regular file" % dst)
+            if (dst_st.st_dev, dst_st.st_ino) == (st.st_dev, st.st_ino):
+                # truncating dst would destroy src
+                raise shutil.SameFileError("%s and %s are the same file" % (src, dst))
+            start = 0
+            if resume:
+                start = os.fstat(dst_fd).st_size
+                if start > st.st_size:
+                    start = 0
+                progress.update(start, src)
+            os.ftruncate(dst_fd, start)
+
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+            method = ['copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile' if hasattr(os, 'sendfile') else 'read']
+            sparse = preserve_sparse and hasattr(os, 'SEEK_DATA') and st.st_blocks * 512 < st.st_size
+            segments = _data_segments(src_fd, start, st.st_size) if sparse else [(start, st.st_size - start)]
+            data_size = 0
+            for (offset, count) in segments:
+                _copy_range(src_fd, dst_fd, offset, count, progress, src, method)
+                data_size += count
+            if st.st_size - start > data_size:
+                # skipped holes
+                progress.update(st.st_size - start - data_size, src)
+            # the file size includes a trailing hole, if any
+            os.ftruncate(dst_fd, st.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    if preserve_metadata:
+        shutil.copystat(src, dst)
+    return dst
+
+
+def copy_tree(src, dst, workers=4, progress=None, resume=False, preserve_sparse=True, preserve_metadata=True,
+              exclude_dirs=None, include_glob=None):
+    """
+    Copies a folder with several files copied in parallel (see copy). Symbolic links (to files or folders)
+    are copied as links. Special files (i.e. named pipes) raise shutil.SpecialFileError.
+    Returns the list of copied files.
+
+    :param src:             folder to copy
+    :param dst:             destination folder (created if needed)
+    :param workers:         number of files copied at the same time
+    :param progress:        optional callback called with (copied_bytes, total_bytes, file_path),
+                            total_bytes is None until all files have been listed
+    :param exclude_dirs:    see iter_files
+    :param include_glob:    see iter_files
+    """
+    src = os.path.abspath(src)
+    exclude_dirs = _as_pattern_list(exclude_dirs)
+    include_glob = _as_pattern_list(include_glob)
+    counter = _ProgressCounter(progress, None)
+    os.makedirs(dst, exist_ok=True)
+
+    def copy_file(item, target):
+        if item.is_symlink():
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(item.path), target)
+        else:
+            copy(item.path, target, progress=counter, resume=resume, preserve_sparse=preserve_sparse,
+                 preserve_metadata=preserve_metadata)
+        return target
+
+    folders = [src]
+    futures = []
+    total = 0
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for (is_folder, item) in _iter_folder_tree(src, exclude_dirs, include_glob, dir_links=True):
+            target = os.path.join(dst, os.path.relpath(item if is_folder else item.path, src))
+            if is_folder:
+                os.makedirs(target, exist_ok=True)
+                folders.append(item)
+                continue
+            if not item.is_symlink():
+                total += item.size
+            futures.append(executor.submit(copy_file, item, target))
+        counter.total = total
+        copied = [future.result() for future in futures]
+
+    if preserve_metadata:
+        # after the copies, which change the folders mtime
+        for folder in folders:
+            shutil.copystat(folder, os.path.join(dst, os.path.relpath(folder, src)))
+    return copied
+
+
+def move(src, dst, **kwargs):
+    """
+    Moves a file or a folder : renamed if on the same file system, otherwise copied (see copy and copy_tree,
+    which receive kwargs) then deleted.
+    Returns the destination path.
+    """
+    if kwargs.get('exclude_dirs') or kwargs.get('include_glob'):
+        # files left out of the copy would be deleted with the source folder
+        raise ValueError("move() can not filter files (exclude_dirs, include_glob)")
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src.rstrip(os.sep)))
+    try:
+        os.rename(src, dst)
+        return dst
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    if os.path.isdir(src) and not os.path.islink(src):
+        copy_tree(src, dst, **kwargs)
+        shutil.rmtree(src)
+    else:
+        copy(src, dst, **kwargs)
+        os.remove(src)
+    return dst
+
+
+def benchmark_scan(depth=4, breadth=6, files_per_folder=20, workers=8, scan_path=None):
+    """
+    Compares os.walk, iter_files and iter_files_parallel on a synthetic tree (created in a temporary folder),
+    or on an existing folder if scan_path is set (i.e. a network share). Returns the timings in seconds.
+    """
+    import tempfile
+
+    tmp_folder = None
+    if not scan_path:
+        scan_path = tmp_folder = tempfile.mkdtemp()
+        folders = [scan_path]
+        for level in range(depth):
+            folders = [os.path.join(f, 'd%d' % i) for f in folders for i in range(breadth)]
+            for folder in folders:
+                os.makedirs(folder)
+                for i in range(files_per_folder):
+                    open(os.path.join(folder, 'f%d.dat' % i), 'w').close()
+
+    def walk():
+        return sum([len(files) for (root, dirs, files) in os.walk(scan_path)])
+
+    timings = {}
+    try:
+        for (name, scan) in [('os.walk', walk),
+                             ('iter_files', lambda: sum(1 for f in iter_files(scan_path, exclude_dirs=None))),
+                             ('iter_files_parallel', lambda: sum(1 for f in iter_files_parallel(scan_path, workers=workers, exclude_dirs=None))),
+                             ('iter_files_parallel (ordered)', lambda: sum(1 for f in iter_files_parallel(scan_path, workers=workers, ordered=True, exclude_dirs=None)))]:
+            start = time.perf_counter()
+            count = scan()
+            timings[name] = time.perf_counter() - start
+            print("%-32s %8d files in %.3f s" % (name, count, timings[name]))
+    finally:
+        if tmp_folder:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+    return timings
+
+
+if __name__ == "__main__":
+    benchmark_scan(scan_path=sys.argv[1] if len(sys.argv) > 1 else None)
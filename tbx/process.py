@@ -19,9 +19,25 @@ import threading
 import re
 import shutil
 import atexit
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import inspect
+import itertools
+import heapq
+import random
+import queue
+import selectors
 
 import logging
 from . import text as text_utils
+from . import code as code_utils
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 
 def restart_program():
@@ -51,10 +67,218 @@ def synchronized(lock):
     return wrap
 
 
+class RateLimitExceeded(Exception):
+    """
+    Raised by rate limiters when a call would have to wait longer than the allowed maximum delay.
+    """
+    pass
+
+
+class _RateLimiter(object):
+    """
+    Base class of rate limiters.
+    Calls are admitted by reserving a slot (reserve()) and then waiting for the returned delay,
+    which allows both threads and asyncio tasks to wait without holding any lock.
+    """
+
+    def __init__(self, max_delay=None):
+        self.max_delay = max_delay
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, now, tokens, max_delay):
+        raise NotImplementedError()
+
+    def reserve(self, tokens=1, max_delay=None):
+        """
+        Reserves tokens and returns the delay (seconds) to wait before using them.
+        Raises RateLimitExceeded (and reserves nothing) if that delay is more than max_delay (defaults to the limiter one).
+        """
+        if max_delay is None:
+            max_delay = self.max_delay
+        with self._lock:
+            now = time.monotonic()
+            self.last_used = now
+            return self._reserve(now, tokens, max_delay)
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes tokens only if they are available right now. Returns True if so.
+        """
+        try:
+            self.reserve(tokens, max_delay=0)
+        except RateLimitExceeded:
+            return False
+        return True
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class TokenBucket(_RateLimiter):
+    """
+    Token bucket rate limiter : allows "rate" calls per second in average, with bursts of up to "capacity" calls.
+
+    :param rate:        number of tokens added per second
+    :param capacity:    maximum number of tokens in the bucket (burst size), defaults to rate (at least 1)
+    :param max_delay:   if set, RateLimitExceeded is raised instead of waiting more than max_delay seconds
+    """
+
+    def __init__(self, rate, capacity=None, max_delay=None):
+        super(TokenBucket, self).__init__(max_delay=max_delay)
+        if rate <= 0:
+            raise ValueError("Rate should be positive (got %r)" % rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = self.last_used
+
+    def _reserve(self, now, tokens, max_delay):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        delay = max(tokens - self.tokens, 0) / self.rate
+        if max_delay is not None and delay > max_delay:
+            raise RateLimitExceeded("Rate limit exceeded (would wait %.3f seconds)" % delay)
+        # tokens can go negative : they are then reserved by callers waiting for their delay
+        self.tokens -= tokens
+        return delay
+
+
+class SlidingWindowLimiter(_RateLimiter):
+    """
+    Sliding window rate limiter : allows at most "limit" calls in any window of "period" seconds.
+    Memory usage is proportional to limit.
+
+    :param limit:       maximum number of calls per period
+    :param period:      window duration in seconds
+    :param max_delay:   if set, RateLimitExceeded is raised instead of waiting more than max_delay seconds
+    """
+
+    def __init__(self, limit, period=1.0, max_delay=None):
+        super(SlidingWindowLimiter, self).__init__(max_delay=max_delay)
+        if limit < 1:
+            raise ValueError("Limit should be at least 1 (got %r)" % limit)
+        self.limit = limit
+        self.period = float(period)
+        self.calls = collections.deque()
+
+    def _reserve(self, now, tokens, max_delay):
+        while self.calls and self.calls[0] <= now - self.period:
+            self.calls.popleft()
+        start = now
+        reserved = []
+        for i in range(tokens):
+            # calls may contain future (reserved) times : the n-th call can start one period after the (n - limit)-th one
+            index = len(self.calls) + i - self.limit
+            if index >= 0:
+                previous = self.calls[index] if index < len(self.calls) else reserved[index - len(self.calls)]
+                start = max(start, previous + self.period)
+            reserved.append(start)
+        delay = start - now
+        if max_delay is not None and delay > max_delay:
+            raise RateLimitExceeded("Rate limit exceeded (would wait %.3f seconds)" % delay)
+        self.calls.extend(reserved)
+        return delay
+
+
+class KeyedRateLimiter(object):
+    """
+    Per key rate limiter (i.e. one limit per remote host).
+    A limiter is created for each key with "factory", and the least recently used keys are evicted
+    once there are more than max_keys of them, so memory usage stays bounded.
+
+    :Usage:
+     >>> per_host = KeyedRateLimiter(lambda: TokenBucket(5, capacity=10), max_keys=1000)
+        per_host.acquire('ftp.partner.com')
+    """
+
+    def __init__(self, factory, max_keys=1024):
+        self.factory = factory
+        self.max_keys = max_keys
+        self._limiters = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            limiter = self._limiters.get(key, None)
+            if limiter is None:
+                limiter = self._limiters[key] = self.factory()
+                while len(self._limiters) > self.max_keys:
+                    self._limiters.popitem(last=False)
+            else:
+                self._limiters.move_to_end(key)
+            return limiter
+
+    def __len__(self):
+        return len(self._limiters)
+
+    def try_acquire(self, key, tokens=1):
+        return self.get(key).try_acquire(tokens)
+
+    def acquire(self, key, tokens=1):
+        self.get(key).acquire(tokens)
+
+    async def acquire_async(self, key, tokens=1):
+        await self.get(key).acquire_async(tokens)
+
+
+def rate_limited(limiter, key=None):
+    """
+    Rate limiting decorator; works on functions and coroutine functions.
+
+    :param limiter:     a TokenBucket, a SlidingWindowLimiter or a KeyedRateLimiter.
+    :param key:         for KeyedRateLimiter, function called with the decorated function arguments, returning the key.
+
+    :Usage:
+     >>> @rate_limited(KeyedRateLimiter(lambda: SlidingWindowLimiter(10, period=60)), key=lambda host, path: host)
+        def upload(host, path):
+            ...
+    """
+    def acquire_args(args, kw):
+        return (key(*args, **kw),) if key else ()
+
+    def wrap(f):
+        if asyncio.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def async_rate_limited(*args, **kw):
+                await limiter.acquire_async(*acquire_args(args, kw))
+                return await f(*args, **kw)
+            return async_rate_limited
+
+        @functools.wraps(f)
+        def sync_rate_limited(*args, **kw):
+            limiter.acquire(*acquire_args(args, kw))
+            return f(*args, **kw)
+        return sync_rate_limited
+    return wrap
+
+
 def call_repeatedly(func, interval, *args, **kwargs):
     """
     Call a function at interval
     Returns both the thread object and the loop stopper Event.
+    Note : it uses one thread per call, see Scheduler (or get_default_scheduler) to run many periodic calls from one thread.
     """
     main_thead = threading.current_thread()
     stopped = threading.Event()
@@ -73,10 +297,218 @@ def call_repeatedly(func, interval, *args, **kwargs):
     return timer_thread, stopped.set
 
 
+class ScheduledJob(object):
+    """
+    Job registered into a Scheduler. Holds the job run statistics.
+    """
+
+    def __init__(self, func, args, kwargs, interval=None, fixed_rate=True, jitter=0.0):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.fixed_rate = fixed_rate
+        self.jitter = jitter
+        self.scheduled = None
+        self.due = None
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lateness = None
+        self.max_lateness = 0.0
+
+    @property
+    def periodic(self):
+        return bool(self.interval)
+
+    def cancel(self):
+        """
+        Cancels the job : it won't be run anymore (a running job is not interrupted).
+        """
+        self.cancelled = True
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'errors': self.errors,
+            'overruns': self.overruns,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'average_duration': self.total_duration / self.runs if self.runs else None,
+            'last_lateness': self.last_lateness,
+            'max_lateness': self.max_lateness,
+        }
+
+    def __repr__(self):
+        return "<ScheduledJob %s (interval=%s, %s)>" % (getattr(self.func, '__name__', self.func), self.interval,
+                                                        'fixed rate' if self.fixed_rate else 'fixed delay')
+
+
+class Scheduler(object):
+    """
+    Runs many one-shot and periodic jobs from a single thread, using a heap of due times (time.monotonic() based).
+
+    Periodic jobs are either :
+    - fixed rate : runs are scheduled every "interval" seconds from the first run, whatever their duration (no drift).
+      If a run takes longer than the interval, the missed runs are skipped and counted as overruns.
+    - fixed delay : the next run is scheduled "interval" seconds after the end of the previous one.
+    A given job never runs concurrently with itself.
+
+    By default jobs are run in the scheduler thread, so they should be short. Set "workers" to run them
+    in a bounded thread pool instead (slow jobs then do not delay the other ones).
+
+    :Usage:
+     >>> scheduler = Scheduler(workers=4).start()
+        job = scheduler.call_every(60, cleanup_temp_folder, jitter=5)
+        scheduler.call_later(10, send_heartbeat)
+        ...
+        job.stats()
+        scheduler.stop()
+    """
+
+    def __init__(self, workers=0, name='tbx-scheduler'):
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers else None
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+                atexit.register(self.stop, wait=False)
+        return self
+
+    def stop(self, wait=True):
+        """
+        Stops the scheduler. Pending jobs are not run anymore.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if wait and self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+
+    def call_later(self, delay, func, args=(), kwargs=None):
+        """
+        Runs func(*args, **kwargs) once, in "delay" seconds. Returns the ScheduledJob.
+        """
+        job = ScheduledJob(func, tuple(args), dict(kwargs or {}))
+        with self._condition:
+            self._push(job, time.monotonic() + delay)
+        return job
+
+    def call_every(self, interval, func, args=(), kwargs=None, fixed_rate=True, jitter=0.0, first_delay=None):
+        """
+        Runs func(*args, **kwargs) every "interval" seconds. Returns the ScheduledJob.
+
+        :param fixed_rate:      True for fixed rate runs, False for fixed delay runs (see Scheduler).
+        :param jitter:          random delay (between 0 and jitter seconds) added to each run, to spread the load.
+        :param first_delay:     delay before the first run (defaults to interval).
+        """
+        if interval <= 0:
+            raise ValueError("Interval should be positive (got %r)" % interval)
+        job = ScheduledJob(func, tuple(args), dict(kwargs or {}), interval=interval, fixed_rate=fixed_rate, jitter=jitter)
+        with self._condition:
+            self._push(job, time.monotonic() + (interval if first_delay is None else first_delay))
+        return job
+
+    def jobs(self):
+        """
+        Returns the list of scheduled (not cancelled) jobs.
+        """
+        with self._condition:
+            return [job for (due, count, job) in self._heap if not job.cancelled]
+
+    def _push(self, job, scheduled):
+        job.scheduled = scheduled
+        job.due = scheduled + (random.uniform(0, job.jitter) if job.jitter else 0.0)
+        heapq.heappush(self._heap, (job.due, next(self._counter), job))
+        self._condition.notify()
+
+    def _loop(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                (due, count, job) = self._heap[0]
+                if job.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                now = time.monotonic()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                job.running = True
+                if self._executor:
+                    self._executor.submit(self._run, job)
+                else:
+                    self._condition.release()
+                    try:
+                        self._run(job)
+                    finally:
+                        self._condition.acquire()
+
+    def _run(self, job):
+        started = time.monotonic()
+        error = False
+        try:
+            job.func(*job.args, **job.kwargs)
+        except Exception:
+            error = True
+            logging.exception("Error while running scheduled job %r" % job)
+        finished = time.monotonic()
+
+        with self._condition:
+            job.running = False
+            job.runs += 1
+            job.errors += 1 if error else 0
+            job.last_duration = finished - started
+            job.max_duration = max(job.max_duration, job.last_duration)
+            job.total_duration += job.last_duration
+            job.last_lateness = started - job.due
+            job.max_lateness = max(job.max_lateness, job.last_lateness)
+            if self._stopped or job.cancelled or not job.periodic:
+                return
+            if job.fixed_rate:
+                scheduled = job.scheduled + job.interval
+                if scheduled < finished:
+                    missed = int((finished - scheduled) // job.interval) + 1
+                    job.overruns += missed
+                    scheduled += missed * job.interval
+            else:
+                scheduled = finished + job.interval
+            self._push(job, scheduled)
+
+
+def get_default_scheduler():
+    """
+    Returns the process-wide default Scheduler (started on first call, and rebuilt in forked child processes).
+    """
+    return code_utils.get_singleton(Scheduler)
+
+
+code_utils.register_singleton(Scheduler, lambda: Scheduler().start(), teardown=lambda scheduler: scheduler.stop())
+
+
 def synchronized_limit(lock):
     """
     Synchronization decorator; provide thread-safe locking on a function
     http://code.activestate.com/recipes/465057/
+    Deprecated : use concurrency_limit instead.
     """
     def wrap(f):
         def synchronize(*args, **kw):
@@ -94,112 +526,921 @@ def synchronized_limit(lock):
     return wrap
 
 
-def execute(command, return_output=True, log_file=None, log_settings=None, error_logfile=None, timeout=None, line_function=None, poll_timing = 0.01, logger=None, working_folder=None, env=None):
+class ConcurrencyLimitExceeded(Exception):
     """
-        Execute a program and logs standard output into a file.
+    Raised by concurrency_limit when no slot is available (reject mode or queue timeout reached).
+    """
+    pass
 
-        :param return_output:      returns the STDOUT value if True or returns the return code
-        :param logfile:            path where log file should be written ( displayed on STDOUT if not set)
-        :param error_logfile:      path where error log file should be written ( displayed on STDERR if not set)
-        :param timeout:            if set, it will kill the subprocess created when "timeout" seconds is reached. It will then raise an Exception.
-        :param line_function:      set it to a "function pointer" for the function to be called each time a new line is written (line passed as a parameter).
-        :param poll_timing:        wait time between timeout checks and std output check.
 
-        :returns:   Standard output of the command or if return_output=False, it will give the "return code" of the command
+class _ThreadWaiter(object):
+    __slots__ = ('lock',)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lock.acquire()
+
+    def wait(self, timeout):
+        return self.lock.acquire(timeout=-1 if timeout is None else timeout)
+
+    def wake(self):
+        self.lock.release()
+
+
+class _AsyncWaiter(object):
+    __slots__ = ('loop', 'future')
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self._set)
+
+    def _set(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class concurrency_limit(object):
     """
+    Bounded concurrency limiter : at most n calls run at the same time, the other ones are queued in FIFO order.
+    Can be used as a decorator (on functions or coroutine functions) or as a context manager (with / async with).
+    Safe to share between threads and asyncio event loops.
 
-    tmp_log = False
-    if log_settings:
-        log_folder = log_settings.get('LOG_FOLDER')
-    else:
-        tmp_log = True
-        log_folder = tempfile.mkdtemp()
+    :Usage:
+     >>> @concurrency_limit(4, queue_timeout=30)
+        def transcode(path):
+            ...
+     >>> api_limit = concurrency_limit(10, reject=True)
+        async def handler(request):
+            async with api_limit:
+                ...
+
+    :param n:               maximum number of concurrent calls
+    :param queue_timeout:   maximum time (seconds) to wait for a slot, ConcurrencyLimitExceeded is raised after that.
+    :param reject:          if True, calls are never queued : ConcurrencyLimitExceeded is raised if no slot is free.
+    """
+
+    def __init__(self, n, queue_timeout=None, reject=False):
+        if n < 1:
+            raise ValueError("Concurrency limit should be at least 1 (got %r)" % n)
+        self.limit = n
+        self.queue_timeout = queue_timeout
+        self.reject = reject
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+
+    def _try_acquire(self, waiter_class):
+        """
+        Takes a slot if one is free (returns None), otherwise returns a queued waiter.
+        """
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                return None
+            if self.reject:
+                self.rejected += 1
+                raise ConcurrencyLimitExceeded("Too busy (%d calls in flight)" % self.in_flight)
+            waiter = waiter_class()
+            self._waiters.append(waiter)
+            self.queued += 1
+            return waiter
+
+    def _dequeue(self, waiter):
+        """
+        Removes a waiter that gave up. Returns False if it has been granted a slot in the meantime.
+        """
+        with self._lock:
+            self.queued -= 1
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                return False
+            return True
+
+    def _granted(self):
+        with self._lock:
+            self.queued -= 1
+
+    def _timed_out(self):
+        with self._lock:
+            self.rejected += 1
+        raise ConcurrencyLimitExceeded("Timed out after %s seconds waiting for a free slot" % self.queue_timeout)
+
+    def acquire(self):
+        waiter = self._try_acquire(_ThreadWaiter)
+        if waiter is None:
+            return
+        if waiter.wait(self.queue_timeout):
+            self._granted()
+        elif self._dequeue(waiter):
+            self._timed_out()
+
+    async def acquire_async(self):
+        waiter = self._try_acquire(_AsyncWaiter)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            self._granted()
+        except asyncio.TimeoutError:
+            if self._dequeue(waiter):
+                self._timed_out()
+        except asyncio.CancelledError:
+            if not self._dequeue(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # the slot is handed over to the first waiter, in_flight does not change
+                self._waiters.popleft().wake()
+            else:
+                self.in_flight -= 1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
 
+    def __call__(self, f):
+        if asyncio.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def async_limited(*args, **kw):
+                async with self:
+                    return await f(*args, **kw)
+            return async_limited
+
+        @functools.wraps(f)
+        def limited(*args, **kw):
+            with self:
+                return f(*args, **kw)
+        return limited
+
+
+class ExecuteTimeout(Exception):
+    """
+    Raised when a command executed through execute() reaches its timeout (the command is killed).
+    """
+    pass
+
+
+_line_separators_re = re.compile(b'[\r\n]')
+
+
+class _LineSplitter(object):
+    """
+    Splits raw output chunks into decoded lines.
+    Both \\n and \\r are considered as line ends, so progress lines (i.e. ffmpeg) are seen as soon as they are written.
+    Empty lines are skipped.
+    """
+
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data):
+        lines = _line_separators_re.split(self.pending + data)
+        self.pending = lines.pop()
+        return self._decode(lines)
+
+    def flush(self):
+        lines, self.pending = [self.pending], b''
+        return self._decode(lines)
+
+    def _decode(self, lines):
+        lines = [text_utils.uni(line).rstrip() for line in lines]
+        return [text_utils.handle_carriage_return(line) for line in lines if line]
+
+
+def _prepare_execute_log(command, timeout, log_file, log_settings, error_logfile):
+    """
+    Opens the log files used by execute() and writes the command header.
+    Returns the log file writer, the error log file writer and the temporary folder to remove after execution (if any).
+    """
+    tmp_folder = None
     if not log_file:
+        if log_settings:
+            log_folder = log_settings.get('LOG_FOLDER')
+        else:
+            log_folder = tmp_folder = tempfile.mkdtemp()
         log_file = os.path.join(log_folder, "commands", "execute-command-logfile-%s.log" % UUID.uuid4())
         try:
             if not os.path.isdir(os.path.join(log_folder, "commands")):
                 os.makedirs(os.path.join(log_folder, "commands"))
         except:
             pass
-    if not logger:
-        logger = logging.getLogger('command_execute')
 
-    logfile_writer = open(log_file, 'a')
+    logfile_writer = open(log_file, 'ab')
     header = "%s - Executing command (timeout=%s) :\n\t%s\n\n\n" % (datetime.now().isoformat(), timeout, command)
-    logfile_writer.write(header)
+    logfile_writer.write(header.encode('utf-8'))
     logfile_writer.flush()
 
-    logfile_reader = open(log_file, 'rb')
-    logfile_reader.seek(0, os.SEEK_END)
-    logfile_start_position = logfile_reader.tell()
+    err_logfile_writer = open(error_logfile, 'ab') if error_logfile else None
+    return logfile_writer, err_logfile_writer, tmp_folder
 
-    if error_logfile:
-        err_logfile_writer = open(error_logfile, 'a')
-    else:
-        err_logfile_writer = logfile_writer
 
-    start = datetime.now()
-    timeout_string = ""
-    if timeout:
-        timeout_string = "(timeout=%s)" % timeout
-    logger.info(u"Executing command %s :\n\t\t%s" % (timeout_string, command) )
+def _close_execute_log(logfile_writer, err_logfile_writer, tmp_folder, logger):
+    try:
+        logfile_writer.close()
+        if err_logfile_writer:
+            err_logfile_writer.close()
+        if tmp_folder:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+    except:
+        logger.exception("Error while cleaning after tbx.execute() call.")
 
+
+def _exec_command(command):
     # We use "exec <command>" as Popen launches a shell, that runs the command.
     # It will transform the child process "sh" into the "command exectable" because of the "exec".
     # Said more accuratly, it won't fork to create launch the command in a sub sub process.
     # Therefore, when you kill the child process, you kill the "command" process and not the unecessary "sh" parent process.
     if sys.platform != 'win32':
-        command = u"exec %s" % text_utils.uni(command)
-    process = subprocess.Popen(command, stdout=logfile_writer, stderr=err_logfile_writer, bufsize=1, shell=True, cwd=working_folder, env=env)
-
-    while process.poll() == None:
-        # In order to avoid unecessary cpu usage, we wait for "poll_timing" seconds ( default: 0.1 sec )
-        time.sleep(poll_timing)
-
-        # Timeout check
-        if timeout != None:
-            now = datetime.now()
-            if (now - start).seconds> timeout:
-                #process.terminate() ??
-                os.kill(process.pid, signal.SIGKILL)
-                os.waitpid(-1, os.WNOHANG)
-                raise Exception("Command execution timed out (took more than %s seconds...)" % timeout)
-
-        # Line function call:
-        #   => if line_function is defined, we call it on each new line of the file.
-        if line_function:
-            o = text_utils.uni(logfile_reader.readline()).rstrip()
-            while o != '':
-                line_function(text_utils.handle_carriage_return(o))
-                o = text_utils.uni(logfile_reader.readline()).rstrip()
+        return u"exec %s" % text_utils.uni(command)
+    return command
+
+
+def _killpg(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        # the whole group is already dead
+        pass
+
+
+def _terminate(process, grace_period=0):
+    """
+    Terminates a command launched in its own process group (session) and all its sub processes, then reaps it.
+    If grace_period is set, SIGTERM is sent to the group first, and SIGKILL only after the command exited
+    or "grace_period" seconds. Only our own child is reaped.
+    """
+    if sys.platform == 'win32':
+        process.kill()
+        process.wait()
+        return
+    if grace_period:
+        _killpg(process, signal.SIGTERM)
+        try:
+            process.wait(timeout=grace_period)
+        except subprocess.TimeoutExpired:
+            pass
+    # the child being not reaped yet (or its group still having members), the process group id can not have been reused
+    _killpg(process, signal.SIGKILL)
+    process.wait()
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def _next_wait(deadline, next_tick):
+    remaining = _remaining(deadline)
+    if next_tick is None:
+        return remaining
+    until_tick = max(next_tick - time.monotonic(), 0)
+    return until_tick if remaining is None else min(remaining, until_tick)
+
+
+_EXIT_POLL_INTERVAL = 0.05
+
+
+def _has_exited(process):
+    """
+    Tells if the child process has exited, without reaping it when possible (os.waitid with WNOWAIT),
+    so that its resource usage can still be collected.
+    """
+    if hasattr(os, 'waitid'):
+        try:
+            return os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+        except ChildProcessError:
+            return True
+    if hasattr(os, 'wait4'):
+        # reaps the child, but keeps its resource usage
+        return _reap(process, os.WNOHANG)
+    return process.poll() is not None
+
+
+def _reap(process, options=0):
+    """
+    Reaps the child process with os.wait4, its resource usage is kept in process._rusage.
+    Returns False if options has WNOHANG and the child is still running.
+    """
+    if process.returncode is not None:
+        return True
+    try:
+        (pid, status, rusage) = os.wait4(process.pid, options)
+    except ChildProcessError:
+        # already reaped
+        return process.poll() is not None
+    if not pid:
+        return False
+    process.returncode = os.waitstatus_to_exitcode(status)
+    process._rusage = rusage
+    return True
+
+
+def _wait_and_reap(process, deadline):
+    """
+    Waits for the child process to exit and reaps it with os.wait4 (see _reap).
+    Raises ExecuteTimeout if the deadline is reached.
+    """
+    delay = 0.001
+    while not _reap(process, os.WNOHANG):
+        remaining = _remaining(deadline)
+        if remaining == 0:
+            raise ExecuteTimeout()
+        time.sleep(delay if remaining is None else min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+def _iter_pipes_output(process, pipes, deadline, tick=None):
+    """
+    Yields (pipe, data) tuples as soon as data is available on one of the pipes, until they are all closed.
+    If tick is set, (None, None) is also yielded every "tick" seconds.
+    Raises ExecuteTimeout if the deadline (time.monotonic() based) is reached.
+    """
+    if sys.platform == 'win32':
+        for item in _iter_pipes_output_threaded(pipes, deadline, tick):
+            yield item
+        return
+
+    # On Linux, the process exit itself can be waited for with a pidfd : if grandchildren keep the pipes open,
+    # we stop reading once the child is dead and its pending output has been read (like the former behaviour did).
+    # Without pidfd (macOS, old kernels), the child is polled every _EXIT_POLL_INTERVAL seconds instead.
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            pidfd = None
+
+    selector = selectors.DefaultSelector()
+    try:
+        for pipe in pipes:
+            selector.register(pipe, selectors.EVENT_READ)
+        if pidfd is not None:
+            selector.register(pidfd, selectors.EVENT_READ)
+        exited = False
+        next_tick = time.monotonic() + tick if tick else None
+        while len(selector.get_map()) > (0 if pidfd is None or exited else 1):
+            if not exited and _remaining(deadline) == 0:
+                raise ExecuteTimeout()
+            wait = 0 if exited else _next_wait(deadline, next_tick)
+            if pidfd is None and not exited:
+                wait = _EXIT_POLL_INTERVAL if wait is None else min(wait, _EXIT_POLL_INTERVAL)
+            events = selector.select(wait)
+            if pidfd is None and not exited and _has_exited(process):
+                exited = True
+                # pending output is read below and until no more data is available
+                events = events or selector.select(0)
+            if next_tick is not None and time.monotonic() >= next_tick:
+                next_tick = time.monotonic() + tick
+                yield None, None
+            if exited and not events:
+                break
+            for (key, _) in events:
+                if key.fileobj == pidfd:
+                    selector.unregister(pidfd)
+                    exited = True
+                    continue
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    continue
+                yield key.fileobj, data
+    finally:
+        selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+def _iter_pipes_output_threaded(pipes, deadline, tick=None):
+    """
+    Fallback of _iter_pipes_output for platforms where pipes can not be used with select (Windows).
+    """
+    output = queue.Queue()
+
+    def reader(pipe):
+        for data in iter(lambda: pipe.read1(65536), b''):
+            output.put((pipe, data))
+        output.put((pipe, b''))
+
+    for pipe in pipes:
+        threading.Thread(target=reader, args=(pipe,), daemon=True).start()
+    opened = len(pipes)
+    next_tick = time.monotonic() + tick if tick else None
+    while opened:
+        try:
+            (pipe, data) = output.get(timeout=_next_wait(deadline, next_tick))
+        except queue.Empty:
+            if _remaining(deadline) == 0:
+                raise ExecuteTimeout()
+            (pipe, data) = (None, None)
+        if next_tick is not None and time.monotonic() >= next_tick:
+            next_tick = time.monotonic() + tick
+            yield None, None
+        if pipe is None:
+            continue
+        if not data:
+            opened -= 1
+            continue
+        yield pipe, data
+
+
+class ExecuteResult(object):
+    """
+    Result of execute(..., return_result=True) : output, return code and resource usage of the command.
+
+    Resource usage comes from os.wait4() (CPU times, max RSS, context switches) and /proc/<pid>/io (I/O bytes),
+    values are None when not available on the platform.
+    Times are in seconds and sizes in bytes.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.pid = None
+        self.output = None
+        self.return_code = None
+        self.wall_time = None
+        self.user_time = None
+        self.system_time = None
+        self.max_rss = None
+        self.read_bytes = None
+        self.write_bytes = None
+        self.read_chars = None
+        self.write_chars = None
+        self.voluntary_context_switches = None
+        self.involuntary_context_switches = None
+        self.samples = []
+
+    @property
+    def cpu_time(self):
+        if self.user_time is None:
+            return None
+        return self.user_time + self.system_time
+
+    def to_dict(self):
+        result = dict(self.__dict__)
+        result['cpu_time'] = self.cpu_time
+        return result
+
+    def __repr__(self):
+        return "<ExecuteResult pid=%s return_code=%s wall=%.3fs cpu=%s max_rss=%s>" % (
+            self.pid, self.return_code, self.wall_time or 0, self.cpu_time, self.max_rss)
+
+    def _set_rusage(self, rusage):
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        # ru_maxrss is in kilobytes on Linux, in bytes on MacOS
+        self.max_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        self.voluntary_context_switches = rusage.ru_nvcsw
+        self.involuntary_context_switches = rusage.ru_nivcsw
+        if self.read_bytes is None:
+            self.read_bytes = rusage.ru_inblock * 512
+            self.write_bytes = rusage.ru_oublock * 512
+
+    def _set_io(self, io):
+        if io:
+            self.read_bytes = io.get('read_bytes')
+            self.write_bytes = io.get('write_bytes')
+            self.read_chars = io.get('rchar')
+            self.write_chars = io.get('wchar')
+
+
+def _read_proc_io(pid):
+    """
+    Returns the /proc/<pid>/io counters as a dict (None if not readable).
+    """
+    try:
+        with open('/proc/%d/io' % pid, 'rb') as f:
+            return dict([(text_utils.uni(k), int(v)) for (k, v) in [line.split(b':') for line in f.read().splitlines()]])
+    except (OSError, ValueError):
+        return None
+
+
+def _sample_process(pid, elapsed):
+    """
+    Reads current resource usage of a running process from /proc. Returns None if not readable.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+        with open('/proc/%d/statm' % pid, 'rb') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    io = _read_proc_io(pid) or {}
+    clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+    return {
+        'time': elapsed,
+        'user_time': int(fields[11]) / clock_ticks,
+        'system_time': int(fields[12]) / clock_ticks,
+        'rss': resident_pages * os.sysconf('SC_PAGE_SIZE'),
+        'read_bytes': io.get('read_bytes'),
+        'write_bytes': io.get('write_bytes'),
+    }
+
+
+def _wait_for_exit(process, deadline):
+    """
+    Waits for the child process to exit, without reaping it (so its /proc entry can still be read).
+    Raises ExecuteTimeout if the deadline is reached.
+    """
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            pidfd = None
+    if pidfd is not None:
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(pidfd, selectors.EVENT_READ)
+                if not selector.select(_remaining(deadline)):
+                    raise ExecuteTimeout()
+        finally:
+            os.close(pidfd)
+        return
+
+    delay = 0.001
+    while os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+        remaining = _remaining(deadline)
+        if remaining == 0:
+            raise ExecuteTimeout()
+        time.sleep(delay if remaining is None else min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+def execute(command, return_output=True, log_file=None, log_settings=None, error_logfile=None, timeout=None, line_function=None, poll_timing = 0.01, logger=None, working_folder=None, env=None, return_result=False, sample_interval=None, kill_grace_period=0):
+    """
+        Execute a program and logs standard output into a file.
+
+        Output is read from pipes as soon as it is available (no polling) and written to the log file.
+        The command is launched in its own process group, so that it can be killed along with its sub processes.
+
+        :param return_output:      returns the STDOUT value if True or returns the return code
+        :param logfile:            path where log file should be written ( displayed on STDOUT if not set)
+        :param error_logfile:      path where error log file should be written ( displayed on STDERR if not set)
+        :param timeout:            if set, it will kill the subprocess created (and all its sub processes) when "timeout" seconds is reached. It will then raise an ExecuteTimeout Exception.
+        :param line_function:      set it to a "function pointer" for the function to be called each time a new line is written (line passed as a parameter).
+        :param poll_timing:        deprecated, not used anymore (output and timeout are now waited for without polling).
+        :param return_result:      if True, returns an ExecuteResult object holding output, return code and resource usage of the command.
+        :param sample_interval:    with return_result, resource usage of the running command is also sampled every "sample_interval" seconds (see ExecuteResult.samples).
+        :param kill_grace_period:  on timeout, the command process group is sent SIGTERM, then SIGKILL after "kill_grace_period" seconds (SIGKILL directly if 0).
+
+        :returns:   Standard output of the command or if return_output=False, it will give the "return code" of the command
+                    (or an ExecuteResult if return_result=True)
+    """
+    if not logger:
+        logger = logging.getLogger('command_execute')
+
+    (logfile_writer, err_logfile_writer, tmp_folder) = _prepare_execute_log(command, timeout, log_file, log_settings, error_logfile)
+
+    timeout_string = ""
+    if timeout:
+        timeout_string = "(timeout=%s)" % timeout
+    logger.info(u"Executing command %s :\n\t\t%s" % (timeout_string, command) )
+
+    start = time.monotonic()
+    deadline = start + timeout if timeout is not None else None
+    result = ExecuteResult(command) if return_result else None
+    try:
+        process = subprocess.Popen(_exec_command(command), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE if err_logfile_writer else subprocess.STDOUT,
+                                   shell=True, cwd=working_folder, env=env, start_new_session=(sys.platform != 'win32'))
+        pipes = [process.stdout] + ([process.stderr] if err_logfile_writer else [])
+        output = []
+        splitter = _LineSplitter()
+        try:
+            tick = sample_interval if result is not None else None
+            for (pipe, data) in _iter_pipes_output(process, pipes, deadline, tick=tick):
+                if pipe is None:
+                    sample = _sample_process(process.pid, time.monotonic() - start)
+                    if sample:
+                        result.samples.append(sample)
+                    continue
+                if pipe is process.stderr:
+                    err_logfile_writer.write(data)
+                    continue
+                logfile_writer.write(data)
+                if return_output:
+                    output.append(data)
+                if line_function:
+                    for line in splitter.feed(data):
+                        line_function(line)
+            if line_function:
+                for line in splitter.flush():
+                    line_function(line)
+            if result is not None and hasattr(os, 'wait4'):
+                # wait4 gives the resource usage of the child, but reaps it : /proc/<pid>/io has to be read before
+                # (only possible if the child exit can be waited for without reaping it)
+                if os.path.isdir('/proc/%d' % process.pid) and (hasattr(os, 'pidfd_open') or hasattr(os, 'waitid')):
+                    _wait_for_exit(process, deadline)
+                    result._set_io(_read_proc_io(process.pid))
+                _wait_and_reap(process, deadline)
+                if getattr(process, '_rusage', None) is not None:
+                    result._set_rusage(process._rusage)
+            return_code = process.wait(timeout=_remaining(deadline))
+        except (ExecuteTimeout, subprocess.TimeoutExpired):
+            _terminate(process, kill_grace_period)
+            raise ExecuteTimeout("Command execution timed out (took more than %s seconds...)" % timeout)
+        except BaseException:
+            # KeyboardInterrupt (the command has its own session, Ctrl-C does not reach it), line_function errors...
+            _terminate(process, kill_grace_period)
+            raise
+        finally:
+            for pipe in pipes:
+                pipe.close()
+    finally:
+        _close_execute_log(logfile_writer, err_logfile_writer, tmp_folder, logger)
+
+    if result is not None:
+        result.pid = process.pid
+        result.return_code = return_code
+        result.wall_time = time.monotonic() - start
+        if return_output:
+            result.output = text_utils.handle_carriage_return(text_utils.uni(b''.join(output)))
+        return result
+
+    if not return_output:
+        return return_code
+
+    return text_utils.handle_carriage_return(text_utils.uni(b''.join(output)))
+
+
+async def _aread_stream(stream, writer, output, line_callback):
+    splitter = _LineSplitter()
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        if output is not None:
+            output.append(data)
+        if line_callback:
+            for line in splitter.feed(data):
+                result = line_callback(line)
+                if inspect.isawaitable(result):
+                    await result
+    if line_callback:
+        for line in splitter.flush():
+            result = line_callback(line)
+            if inspect.isawaitable(result):
+                await result
+
+
+async def aexecute(command, return_output=True, log_file=None, log_settings=None, error_logfile=None, timeout=None, line_callback=None, logger=None, working_folder=None, env=None, kill_grace_period=0):
+    """
+        Asyncio version of execute() : execute a program and logs standard output into a file.
+        The command is launched in its own process group, which is killed if the coroutine is cancelled.
+
+        :param return_output:      returns the STDOUT value if True or returns the return code
+        :param logfile:            path where log file should be written ( displayed on STDOUT if not set)
+        :param error_logfile:      path where error log file should be written ( displayed on STDERR if not set)
+        :param timeout:            if set, it will kill the subprocess created when "timeout" seconds is reached. It will then raise an ExecuteTimeout Exception.
+        :param line_callback:      function or coroutine function to be called each time a new line is written (line passed as a parameter).
+        :param kill_grace_period:  on timeout or cancellation, the command process group is sent SIGTERM, then SIGKILL after "kill_grace_period" seconds (SIGKILL directly if 0).
+
+        :returns:   Standard output of the command or if return_output=False, it will give the "return code" of the command
+    """
+    if not logger:
+        logger = logging.getLogger('command_execute')
+
+    (logfile_writer, err_logfile_writer, tmp_folder) = _prepare_execute_log(command, timeout, log_file, log_settings, error_logfile)
+
+    timeout_string = ""
+    if timeout:
+        timeout_string = "(timeout=%s)" % timeout
+    logger.info(u"Executing command %s :\n\t\t%s" % (timeout_string, command) )
+
+    try:
+        stderr = asyncio.subprocess.PIPE if err_logfile_writer else asyncio.subprocess.STDOUT
+        if sys.platform == 'win32':
+            process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=stderr,
+                                                            cwd=working_folder, env=env)
+        else:
+            process = await asyncio.create_subprocess_exec('/bin/sh', '-c', _exec_command(command),
+                                                           stdout=asyncio.subprocess.PIPE, stderr=stderr,
+                                                           cwd=working_folder, env=env, start_new_session=True)
+        output = [] if return_output else None
+
+        async def communicate():
+            readers = [_aread_stream(process.stdout, logfile_writer, output, line_callback)]
+            if err_logfile_writer:
+                readers.append(_aread_stream(process.stderr, err_logfile_writer, None, None))
+            await asyncio.gather(*readers)
+            return await process.wait()
+
+        try:
+            return_code = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            await _aterminate(process, kill_grace_period)
+            raise ExecuteTimeout("Command execution timed out (took more than %s seconds...)" % timeout)
+        except BaseException:
+            # task cancellation, line_callback errors...
+            await _aterminate(process, kill_grace_period)
+            raise
+    finally:
+        _close_execute_log(logfile_writer, err_logfile_writer, tmp_folder, logger)
 
     if not return_output:
-        # Return result code and ensure we have waited for the end of sub process
-        return process.wait()
+        return return_code
+
+    return text_utils.handle_carriage_return(text_utils.uni(b''.join(output)))
+
+
+async def _aterminate(process, grace_period=0):
+    """
+    Asyncio version of _terminate.
+    """
+    if sys.platform == 'win32':
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        return
+    if grace_period:
+        _killpg(process, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), grace_period)
+        except asyncio.TimeoutError:
+            pass
+    _killpg(process, signal.SIGKILL)
+    await process.wait()
+
 
-    logfile_reader.seek(logfile_start_position, os.SEEK_SET) #back to the beginning of the file
+class CommandResult(object):
+    """
+    Result of a command executed through run_many().
+    """
+
+    def __init__(self, index, command, priority=0):
+        self.index = index
+        self.command = command
+        self.priority = priority
+        self.result = None
+        self.exception = None
+        self.attempts = 0
+        self.duration = 0.0
 
-    res = text_utils.handle_carriage_return(text_utils.uni(logfile_reader.read()))
+    @property
+    def succeeded(self):
+        return self.exception is None
+
+    def __repr__(self):
+        return "<CommandResult #%d %r (attempts=%d, duration=%.3fs, %s)>" % (
+            self.index, self.command, self.attempts, self.duration, 'OK' if self.succeeded else repr(self.exception))
+
+
+def _run_many_job(index, job, execute_kwargs, retries, retry_delay, retry_backoff, retry_if, stopped):
+    job = dict(job)
+    priority = job.pop('priority', 0)
+    retries = job.pop('retries', retries)
+    kwargs = dict(execute_kwargs)
+    kwargs.update(job)
+    command_result = CommandResult(index, kwargs['command'], priority=priority)
+    start = time.monotonic()
+    while True:
+        command_result.attempts += 1
+        try:
+            command_result.result = execute(**kwargs)
+            command_result.exception = None
+            retry = bool(retry_if and retry_if(command_result.result))
+        except Exception as e:
+            command_result.exception = e
+            retry = True
+        if not retry or command_result.attempts > retries or stopped.is_set():
+            break
+        if stopped.wait(retry_delay * (retry_backoff ** (command_result.attempts - 1))):
+            break
+    command_result.duration = time.monotonic() - start
+    return command_result
+
+
+def run_many(commands, max_parallel=None, retries=0, retry_delay=1.0, retry_backoff=2.0, retry_if=None, **execute_kwargs):
+    """
+        Execute many commands (see execute()) with at most max_parallel commands running at the same time.
+        This is a generator : CommandResult objects are yielded in completion order.
+        Commands are started when iteration begins, and no more commands are started once the generator is closed.
+
+        :param commands:           list of commands. Each one is either a command string, or a dict of execute() arguments
+                                   (i.e. {'command': 'ffprobe a.mov', 'timeout': 30, 'log_file': '/tmp/a.log'}) that can also contain
+                                   a 'priority' (commands with the lowest priority are started first, default 0)
+                                   and a 'retries' key (overrides the retries argument for that command).
+        :param max_parallel:       maximum number of commands running at the same time (defaults to the number of CPUs).
+        :param retries:            number of retries when a command raises an exception (i.e. timeout) or when retry_if returns True.
+        :param retry_delay:        wait time (seconds) before the first retry.
+        :param retry_backoff:      multiplier applied to the wait time after each retry.
+        :param retry_if:           function called with the command result (output or return code), returns True if it should be retried.
+        :param execute_kwargs:     default execute() arguments for all commands.
+
+        :returns:   iterator over CommandResult objects, in completion order.
+    """
+    jobs = queue.PriorityQueue()
+    results = queue.Queue()
+    stopped = threading.Event()
+
+    count = 0
+    for (index, job) in enumerate(commands):
+        if not isinstance(job, dict):
+            job = {'command': job}
+        if 'command' not in job:
+            raise ValueError("Command #%d has no 'command' key : %r" % (index, job))
+        if not isinstance(job.get('retries', 0), int):
+            raise ValueError("Command #%d 'retries' should be an int : %r" % (index, job))
+        jobs.put((job.get('priority', 0), index, job))
+        count += 1
+
+    def worker():
+        while not stopped.is_set():
+            try:
+                (priority, index, job) = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = _run_many_job(index, job, execute_kwargs, retries, retry_delay, retry_backoff, retry_if, stopped)
+            except BaseException as e:
+                # a result is always put, otherwise the generator would wait for it forever
+                result = CommandResult(index, job.get('command'), priority=priority)
+                result.exception = e
+            results.put(result)
+
+    max_parallel = max_parallel or os.cpu_count() or 1
+    for i in range(min(max_parallel, count)):
+        threading.Thread(target=worker, daemon=True).start()
 
     try:
-        logfile_reader.close()
-        logfile_writer.close()
-        err_logfile_writer.close()
+        for i in range(count):
+            yield results.get()
+    finally:
+        stopped.set()
 
-        if tmp_log:
-            shutil.rmtree(log_folder, ignore_errors=True)
-    except:
-        logger.exception("Error while cleaning after tbx.execute() call.")
 
-    return res
+def _open_fds():
+    """
+    Returns the list of open file descriptors of the current process (None if they can not be listed).
+    """
+    for fd_folder in ('/proc/self/fd', '/dev/fd'):
+        try:
+            # note : the listing itself uses a file descriptor, that will be closed once listing is done
+            return [int(fd) for fd in os.listdir(fd_folder)]
+        except (OSError, ValueError):
+            continue
+    return None
+
 
+def close_fds(keep_fds=None, max_fd=1024):
+    """
+    Closes all file descriptors of the current process, except the ones in keep_fds.
+    Open descriptors are listed from /proc/self/fd (or /dev/fd), and closed by ranges with os.closerange
+    (close_range syscall on recent Linux), instead of one close() call per possible descriptor.
 
-def daemonize(umask=0, work_dir="/", max_fd=1024, redirect="/dev/null"):
+    :param keep_fds:    list of file descriptors to keep open
+    :param max_fd:      highest file descriptor to close if open descriptors can not be listed and there is no file limit
+    """
+    keep_fds = sorted(set([fd for fd in (keep_fds or []) if fd >= 0]))
+    open_fds = _open_fds()
+    if open_fds is not None:
+        upper = max(open_fds + [-1]) + 1
+    else:
+        import resource
+        upper = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if upper == resource.RLIM_INFINITY:
+            upper = max_fd
+
+    start = 0
+    for fd in keep_fds + [upper]:
+        if fd > start:
+            os.closerange(start, min(fd, upper))
+        start = max(start, fd + 1)
+        if start >= upper:
+            break
+
+
+def daemonize(umask=0, work_dir="/", max_fd=1024, redirect="/dev/null", keep_fds=None):
     """
     When this function is called, the process is daemonized (by forking + killing its parent).
     It becomes a background task.
     It is useful to release the console.
+
+    :param keep_fds:    list of file descriptors (other than standard input/output/error) to keep open, i.e. for socket handoff.
     """
     if not redirect:
         redirect = "/dev/null"
@@ -234,20 +1475,12 @@ def daemonize(umask=0, work_dir="/", max_fd=1024, redirect="/dev/null"):
         os._exit(0)
 
     #killing inherited file descriptors
-    import resource
-    maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
-    if maxfd == resource.RLIM_INFINITY:
-        maxfd = max_fd
+    close_fds(keep_fds=[fd for fd in (keep_fds or []) if fd > 2], max_fd=max_fd)
 
-    # close all file descriptors.
-    for fd in range(0, maxfd):
-        try:
-            os.close(fd)
-        except OSError:
-            # ignored
-            pass
-
-    os.open(redirect, os.O_RDWR) # standard input
+    fd = os.open(redirect, os.O_RDWR) # standard input
+    if fd != 0:
+        os.dup2(fd, 0)
+        os.close(fd)
 
     # Duplicate standard
     os.dup2(0, 1)			# standard output (1)
@@ -256,12 +1489,127 @@ def daemonize(umask=0, work_dir="/", max_fd=1024, redirect="/dev/null"):
     return os.getpid()
 
 
-def is_running(process):
-    s = subprocess.Popen(["ps", "axw"], stdout=subprocess.PIPE)
-    for x in s.stdout:
-        if re.search(process, x):
-            return True
-    return False
+__process_table_cache = [0.0, None]
+__process_table_lock = threading.Lock()
+
+
+def _read_proc_process(pid):
+    with open('/proc/%d/status' % pid, 'rb') as f:
+        status = dict([line.split(b':', 1) for line in f.read().splitlines() if b':' in line])
+    with open('/proc/%d/cmdline' % pid, 'rb') as f:
+        args = [text_utils.uni(arg) for arg in f.read().split(b'\0') if arg]
+    return {
+        'pid': pid,
+        'ppid': int(status[b'PPid']),
+        'name': text_utils.uni(status[b'Name'].strip()),
+        'uid': int(status[b'Uid'].split()[0]),
+        'args': args,
+        'cmdline': ' '.join(args),
+    }
+
+
+def _proc_process_table():
+    table = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            table.append(_read_proc_process(int(entry)))
+        except (OSError, KeyError, ValueError, IndexError):
+            # process ended while reading it (or is not readable)
+            continue
+    return table
+
+
+def _psutil_process_table():
+    table = []
+    for p in psutil.process_iter(['pid', 'ppid', 'name', 'uids', 'cmdline']):
+        info = p.info
+        args = info['cmdline'] or []
+        table.append({
+            'pid': info['pid'],
+            'ppid': info['ppid'],
+            'name': info['name'],
+            'uid': info['uids'].real if info['uids'] else None,
+            'args': args,
+            'cmdline': ' '.join(args),
+        })
+    return table
+
+
+def _ps_process_table():
+    output = subprocess.check_output(["ps", "axwwo", "pid=,ppid=,uid=,comm=,args="])
+    table = []
+    for line in text_utils.uni(output).splitlines():
+        fields = line.split(None, 4)
+        if len(fields) < 4:
+            continue
+        args = fields[4].split() if len(fields) > 4 else []
+        table.append({
+            'pid': int(fields[0]),
+            'ppid': int(fields[1]),
+            'name': os.path.basename(fields[3]),
+            'uid': int(fields[2]),
+            'args': args,
+            'cmdline': fields[4] if len(fields) > 4 else '',
+        })
+    return table
+
+
+def get_process_table(cache_ttl=0):
+    """
+    Returns the list of running processes, as dicts with 'pid', 'ppid', 'name', 'uid', 'args' and 'cmdline' keys.
+    Uses psutil when available, otherwise reads /proc (no fork), otherwise runs "ps".
+
+    :param cache_ttl:    if set, a process table read less than cache_ttl seconds ago is returned instead of reading it again.
+    """
+    with __process_table_lock:
+        (timestamp, table) = __process_table_cache
+        if cache_ttl and table is not None and time.monotonic() - timestamp < cache_ttl:
+            return table
+    if psutil:
+        table = _psutil_process_table()
+    elif os.path.isdir('/proc/self'):
+        table = _proc_process_table()
+    else:
+        table = _ps_process_table()
+    with __process_table_lock:
+        __process_table_cache[:] = [time.monotonic(), table]
+    return table
+
+
+def find_processes(pattern=None, name=None, cmdline=None, uid=None, cache_ttl=0):
+    """
+    Returns running processes matching all the given filters (see get_process_table for the process dicts).
+
+    :param pattern:      regular expression searched in the process command line (or name if it has no command line)
+    :param name:         exact process name
+    :param cmdline:      string contained in the process command line
+    :param uid:          user id of the process
+    :param cache_ttl:    see get_process_table
+    """
+    if pattern is not None and not hasattr(pattern, 'search'):
+        pattern = re.compile(pattern)
+    result = []
+    for p in get_process_table(cache_ttl=cache_ttl):
+        if name is not None and p['name'] != name:
+            continue
+        if uid is not None and p['uid'] != uid:
+            continue
+        if cmdline is not None and cmdline not in p['cmdline']:
+            continue
+        if pattern is not None and not pattern.search(p['cmdline'] or p['name']):
+            continue
+        result.append(p)
+    return result
+
+
+def is_running(process, cache_ttl=0):
+    """
+    Returns True if a running process command line matches the "process" regular expression.
+    See find_processes.
+    """
+    return len(find_processes(pattern=process, cache_ttl=cache_ttl)) > 0
 
 
 if __name__ == "__main__":
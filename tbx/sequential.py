@@ -10,8 +10,78 @@ import os
 import re
 import os.path
 import glob
+import collections
+import functools
+import itertools
+import math
+import operator
 from . import code as code_utils
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_uuid_re = re.compile(u'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+_particles_re = re.compile(r'(\D+)')
+_digits_re = re.compile(r'(\d+)')
+
+
+def _to_ints(column):
+    """
+    Converts a column of digit strings to a list of ints.
+    """
+    return list(map(int, column))
+
+
+def _number_columns(parts, names):
+    """
+    Returns the number columns of names following the same template : the non numeric parts around the numbers
+    (i.e. ['shot_v', '.', '.exr'] for 'shot_v001.0001.exr'), None if a name does not follow it.
+    All names are tokenized by a single regular expression pass.
+    """
+    group_count = len(parts) - 1
+    template = re.compile('^' + '(\\d+)'.join(re.escape(part) for part in parts) + '$', re.MULTILINE)
+    joined = '\n'.join(names)
+    if joined.count('\n') == len(names) - 1:
+        matches = template.findall(joined)
+        if len(matches) != len(names):
+            return None
+    else:
+        # new lines in names
+        found = [template.fullmatch(name) for name in names]
+        if None in found:
+            return None
+        matches = [match.group(1) if group_count == 1 else match.groups() for match in found]
+    if group_count == 0:
+        return []
+    if group_count == 1:
+        return [matches]
+    # flattened then sliced : much faster than transposing with zip(*matches)
+    flat = list(itertools.chain.from_iterable(matches))
+    return [flat[k::group_count] for k in range(group_count)]
+
+
+def _constant_step(values):
+    """
+    Returns the step between consecutive values if it is the same all along and not null, 0 otherwise.
+    Differences are vectorised with NumPy when available.
+    """
+    if len(values) < 2:
+        return 0
+    if numpy is not None and len(values) > 1000:
+        try:
+            steps = numpy.diff(numpy.array(values, dtype=numpy.int64))
+        except OverflowError:
+            pass
+        else:
+            step = int(steps[0])
+            return step if step and (steps == step).all() else 0
+    steps = list(map(operator.sub, values[1:], values[:-1]))
+    step = steps[0]
+    return step if step and steps.count(step) == len(steps) else 0
+
 
 class SequentialCandidate(code_utils.SerializableObject):
     """
@@ -25,9 +95,14 @@ class SequentialCandidate(code_utils.SerializableObject):
         self.type = "SequentialCandidate"
         self.args = sorted(args)
         self.number_of_args = len(self.args)
-        self.uuid_re = u'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
-        if re.search(self.uuid_re, self.args[0]):
-            args_uuid_safe = map(self._mark_uuid, self.args)
+        self.uuid_re = _uuid_re.pattern
+        if _uuid_re.search(self.args[0]):
+            joined = '\n'.join(self.args)
+            if joined.count('\n') == len(self.args) - 1:
+                # one substitution over all the names
+                args_uuid_safe = self._mark_uuid(joined).split('\n')
+            else:
+                args_uuid_safe = [self._mark_uuid(arg) for arg in self.args]
         else:
             args_uuid_safe = self.args
         self._check_sequential(args_uuid_safe)
@@ -37,76 +112,71 @@ class SequentialCandidate(code_utils.SerializableObject):
         self.ffmpeg_composite = ''
         self.sequence = False
         self.orders = []
-        splits = []
-        for token in args:
-            splits.append(self._numeric_and_non_numeric_particles(os.path.basename(token)))
-        for index in range(len(splits[0])):
-            column = []
-            for row in splits:
-                # catch dangling ends of variable-sized split lists
-                if index > len(row) - 1:
-                    column.append('')
-                else:
-                    if re.match('\d+', row[index]):
-                        numerical = True
-                        column.append(row[index])
-                    else:
-                        numerical = False
-                        column.append(row[index])
-            if numerical:
-                continuous, order, step = self._test_continuity(column)
-            else:
-                continuous = False
+
+        names = [token.rpartition(os.sep)[2] for token in args] if not os.altsep else [os.path.basename(token) for token in args]
+        for (index, column) in enumerate(self._particle_columns(names)):
+            first = column[0]
+            # re.split with a capturing group alternates : even particles are numbers, odd particles are not
+            numerical = index % 2 == 0 and column[-1] != ''
+            constant = column.count(first) == len(column)
+            continuous = False
+            # a constant column is never continuous (null step)
+            if numerical and not constant and all(column):
+                values = _to_ints(column)
+                step = _constant_step(values)
+                if step:
+                    continuous = True
+                    order = ('ascending by ' if step > 0 else 'descending by ') + str(step)
             if continuous:
                 self.sequence = True
                 self.orders.append(order)
-                self.first = int(column[0])
-                self.last = int(column[-1])
-                self.composite += '[' + str(column[0]) + '-' + str(column[-1]) + ']'
-                self.ffmpeg_composite += "%%%sd" % str(len(str(column[-1])))
+                self.first = values[0]
+                self.last = values[-1]
+                self.composite += '[' + first + '-' + column[-1] + ']'
+                self.ffmpeg_composite += "%%%sd" % str(len(column[-1]))
+            elif constant:
+                self.composite += first
+                self.ffmpeg_composite += first
             else:
-                if len(list(set(column))) == 1:
-                    self.composite += str(column[0])
-                    self.ffmpeg_composite += str(column[0])
-                else:
-                    self.composite += '[GARBLED]'
-                    self.ffmpeg_composite += "*"
+                self.composite += '[GARBLED]'
+                self.ffmpeg_composite += "*"
+
+    def _particle_columns(self, names):
+        """
+        Returns the columns of particles of the names (see _numeric_and_non_numeric_particles), as many as the particles
+        of the first name, dangling ends being padded with ''.
+        When all names follow the template of the first name (same non numeric particles), they are tokenized at once
+        (see _number_columns), otherwise each name is split.
+        """
+        first = self._numeric_and_non_numeric_particles(names[0])
+        columns = _number_columns(_digits_re.split(names[0])[::2], names)
+        if columns is not None:
+            # re.split with a capturing group alternates : even particles are numbers, odd particles are not
+            numbers = iter(columns)
+            return [next(numbers) if p and i % 2 == 0 else (p,) * len(names) for (i, p) in enumerate(first)]
+
+        splits = [self._numeric_and_non_numeric_particles(name) for name in names]
+        width = len(first)
+        if any(len(row) != width for row in splits):
+            return list(itertools.islice(itertools.zip_longest(*splits, fillvalue=''), width))
+        return list(zip(*splits))
 
     def _numeric_and_non_numeric_particles(self, token):
-        splits = re.split('(\D+)', token)
-        return splits
+        return _particles_re.split(token)
 
     def _test_continuity(self, sequence):
-        continuous = False
-        continuity_broken = False
-        order = ''
-        step = 0
+        if len(sequence) < 2:
+            return False, 'None', 0
         try:
-            initial_step = int(sequence[1]) - int(sequence[0])
-        except:
+            step = _constant_step(_to_ints(sequence))
+        except ValueError:
             return False, 'None', 0
-        for index, element in enumerate(sequence):
-            if index == len(sequence) - 1:
-                break
-            else:
-                step = int(sequence[index + 1]) - int(sequence[index])
-                if step == 0:
-                    break
-                elif step == initial_step:
-                    continue
-                elif step != initial_step:
-                    continuity_broken = True
-                    break
-        if step != 0 and not continuity_broken:
-            continuous = True
-            if step > 0:
-                order = 'ascending by ' + str(step)
-            else:
-                order = 'descending by ' + str(step)
-        return continuous, order, step
+        if not step:
+            return False, '', 0
+        return True, ('ascending by ' if step > 0 else 'descending by ') + str(step), step
 
     def _mark_uuid(self, string):
-        return re.sub(self.uuid_re, '[UUID]', string)
+        return _uuid_re.sub('[UUID]', string)
 
     def __str__(self):
         return self.composite
@@ -115,12 +185,242 @@ class SequentialCandidate(code_utils.SerializableObject):
 class SequentialFolder(SequentialCandidate):
     """
     Detects File Sequences in a folder.
+    The files of the folder are listed (glob) unless they are given (i.e. by a caller which already listed the folder).
     """
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, files=None):
         self.folder_path = folder_path.rstrip('*').rstrip('/').rstrip('\\')
-        args = glob.glob(os.path.join(self.folder_path, '*'))
-        args = [os.path.join(self.folder_path, arg) for arg in args if os.path.isfile(os.path.join(self.folder_path, arg))]
+        if files is None:
+            args = glob.glob(os.path.join(self.folder_path, '*'))
+            args = [os.path.join(self.folder_path, arg) for arg in args if os.path.isfile(os.path.join(self.folder_path, arg))]
+        else:
+            args = list(files)
         SequentialCandidate.__init__(self, args)
         self.type = "SequentialFolder"
 
 
+def _format_ranges(frames, step):
+    """
+    Formats sorted frame numbers as ranges (i.e. "1-100,102-500", "1-99x2,103").
+    """
+    if not frames:
+        return ''
+    suffix = 'x%d' % step if step != 1 else ''
+    breaks = [i + 1 for (i, diff) in enumerate(map(operator.sub, frames[1:], frames[:-1])) if diff != step]
+    ranges = []
+    for (start, end) in zip([0] + breaks, breaks + [len(frames)]):
+        if end - start == 1:
+            ranges.append(str(frames[start]))
+        else:
+            ranges.append('%d-%d%s' % (frames[start], frames[end - 1], suffix))
+    return ','.join(ranges)
+
+
+def parse_ranges(ranges):
+    """
+    Returns the list of frame numbers of ranges formatted like FileSequence ranges (i.e. "1-100,102-500", "1-99x2").
+    """
+    frames = []
+    for part in ranges.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        (part, _, step) = part.partition('x')
+        (first, _, last) = part.partition('-')
+        frames.extend(range(int(first), int(last or first) + 1, int(step or 1)))
+    return frames
+
+
+class FileSequence(code_utils.SerializableObject):
+    """
+    File sequence found by group_files(), possibly with missing frames.
+    Frames are stored as ranges (i.e. "1-100,102-500") rather than as a list of files, so that the object
+    stays small once serialized (to_dict) whatever the number of frames.
+
+    :param folder:          folder of the files
+    :param prefix:          file name part before the frame number
+    :param suffix:          file name part after the frame number
+    :param frames:          sorted list of frame numbers
+    :param padding:         width of the frame numbers (zero padded), 1 for non padded numbers
+    :param step:            step between frames
+    """
+
+    def __init__(self, folder, prefix, suffix, frames, padding=1, step=1):
+        self.type = "FileSequence"
+        self.folder = folder
+        self.prefix = prefix
+        self.suffix = suffix
+        self.padding = padding
+        self.step = step
+        self.first = frames[0]
+        self.last = frames[-1]
+        self.count = len(frames)
+        self.ranges = _format_ranges(frames, step)
+        expected = (self.last - self.first) // step + 1
+        self.missing = expected - self.count
+        self.missing_ranges = ''
+        if self.missing:
+            present = set(frames)
+            self.missing_ranges = _format_ranges([f for f in range(self.first, self.last + 1, step) if f not in present], step)
+
+    @property
+    def pattern(self):
+        """
+        printf/ffmpeg style pattern of the file paths (i.e. "/renders/shot.%04d.exr").
+        """
+        number = '%0' + str(self.padding) + 'd' if self.padding > 1 else '%d'
+        return os.path.join(self.folder, self.prefix.replace('%', '%%') + number + self.suffix.replace('%', '%%'))
+
+    def frames(self):
+        return parse_ranges(self.ranges)
+
+    def missing_frames(self):
+        return parse_ranges(self.missing_ranges)
+
+    def frame_path(self, frame):
+        return os.path.join(self.folder, self.prefix + str(frame).zfill(self.padding) + self.suffix)
+
+    def paths(self):
+        return [self.frame_path(frame) for frame in self.frames()]
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        # frame numbers padded, steps left as is (i.e. "[0001-0099x2]")
+        ranges = re.sub(r'(?<![x\d])\d+', lambda match: match.group().zfill(self.padding), self.ranges)
+        return self.prefix + '[' + ranges + ']' + self.suffix
+
+    def __repr__(self):
+        return "<FileSequence %s%s>" % (os.path.join(self.folder, str(self)), ' (%d missing)' % self.missing if self.missing else '')
+
+
+def _split_cluster(folder, parts, paths, names, min_length):
+    """
+    Splits files sharing the same folder and template into sequences.
+    The frame number is the last number which varies, files which differ by another number (i.e. versions)
+    are split into different sequences.
+    Returns a (sequences, loose_files) tuple.
+    """
+    columns = _number_columns(parts, names)
+    varying = [k for (k, column) in enumerate(columns) if column.count(column[0]) != len(column)]
+    if not varying:
+        return [], paths
+    frame_column = varying[-1]
+
+    subclusters = collections.OrderedDict()
+    if len(varying) == 1:
+        subclusters[None] = list(range(len(paths)))
+    else:
+        keys = zip(*[columns[k] for k in varying[:-1]])
+        for (i, key) in enumerate(keys):
+            subclusters.setdefault(key, []).append(i)
+
+    sequences = []
+    loose = []
+    for rows in subclusters.values():
+        strings = [columns[frame_column][i] for i in rows] if len(rows) != len(paths) else columns[frame_column]
+        padded = [string for string in strings if len(string) > 1 and string[0] == '0']
+        lengths = set(map(len, strings))
+        if padded:
+            padding = len(padded[0])
+        elif len(lengths) == 1:
+            # i.e. 1001 to 1100
+            padding = len(strings[0])
+        else:
+            padding = 1
+        frame_numbers = _to_ints(strings)
+        if (not padded or lengths == {padding}) and len(set(frame_numbers)) == len(frame_numbers):
+            frame_numbers.sort()
+        else:
+            # files with another padding or duplicated frame numbers can not be part of the sequence
+            frames = {}
+            for (i, string, frame) in zip(rows, strings, frame_numbers):
+                if frame in frames or string != str(frame).zfill(padding):
+                    loose.append(paths[i])
+                else:
+                    frames[frame] = i
+            frame_numbers = sorted(frames)
+            rows = [frames[frame] for frame in frame_numbers]
+        if len(frame_numbers) < max(min_length, 2):
+            loose.extend(paths[i] for i in rows)
+            continue
+        step = functools.reduce(math.gcd, set(map(operator.sub, frame_numbers[1:], frame_numbers[:-1])))
+        first_row = rows[0]
+        numbers = [column[first_row] for column in columns]
+        prefix = ''.join(part + number for (part, number) in zip(parts[:frame_column], numbers[:frame_column])) + parts[frame_column]
+        suffix = parts[frame_column + 1] + ''.join(number + part for (number, part) in zip(numbers[frame_column + 1:], parts[frame_column + 2:]))
+        sequences.append(FileSequence(folder, prefix, suffix, frame_numbers, padding=padding, step=step))
+    return sequences, loose
+
+
+def group_files(paths, min_length=2):
+    """
+    Splits a list of files (i.e. the content of folders) into file sequences and loose files.
+    Files are clustered by folder and name template (the name with its numbers masked), then each cluster is split
+    into sequences on its last varying number (i.e. a folder holding "shot_v001.0001.exr" to "shot_v001.0100.exr"
+    and "shot_v002.0001.exr" to "shot_v002.0050.exr" gives two sequences).
+    Sequences may have missing frames (see FileSequence.ranges and FileSequence.missing_ranges).
+    Returns a (sequences, loose_files) tuple, sequences being FileSequence objects.
+
+    :param paths:       list of file paths
+    :param min_length:  minimum number of files of a sequence
+    """
+    paths = [os.fspath(path) for path in paths]
+    if os.altsep:
+        splits = [os.path.split(path) for path in paths]
+    else:
+        splits = [path.rpartition(os.sep)[::2] for path in paths]
+    names = [name for (folder, name) in splits]
+
+    # numbers are masked with '\0', which can not be part of a file name
+    joined = '\n'.join(names)
+    if joined.count('\n') == len(names) - 1 and '\0' not in joined:
+        templates = _digits_re.sub('\0', joined).split('\n')
+    else:
+        templates = [_digits_re.sub('\0', name) for name in names]
+
+    clusters = collections.OrderedDict()
+    for (i, (folder, template)) in enumerate(zip((folder for (folder, name) in splits), templates)):
+        clusters.setdefault((folder, template), []).append(i)
+
+    sequences = []
+    loose = []
+    for ((folder, template), rows) in clusters.items():
+        if len(rows) < max(min_length, 2) or '\0' not in template:
+            loose.extend(paths[i] for i in rows)
+            continue
+        (found, loose_files) = _split_cluster(folder, template.split('\0'), [paths[i] for i in rows], [names[i] for i in rows], min_length)
+        sequences.extend(found)
+        loose.extend(loose_files)
+    sequences.sort(key=lambda sequence: (sequence.folder, sequence.prefix, sequence.suffix))
+    return sequences, sorted(loose)
+
+
+def benchmark_detection(frames=1000000, sequences=1):
+    """
+    Times the detection of synthetic sequences of "frames" frames (file names only, nothing is written on disk).
+    Returns the timings in seconds.
+    """
+    import time
+
+    names = ['/renders/shot_%03d/shot_%03d_v002.%07d.exr' % (s, s, i) for s in range(sequences) for i in range(1, frames + 1)]
+    timings = {}
+
+    start = time.perf_counter()
+    candidate = SequentialCandidate(names[:frames])
+    timings['SequentialCandidate'] = time.perf_counter() - start
+    assert candidate.sequence
+
+    start = time.perf_counter()
+    (found, loose) = group_files(names)
+    timings['group_files'] = time.perf_counter() - start
+    assert len(found) == sequences and not loose
+
+    print("%d frames x %d sequence(s), numpy %s" % (frames, sequences, 'enabled' if numpy is not None else 'not available'))
+    for (name, duration) in timings.items():
+        print("  %-20s %.3fs" % (name, duration))
+    return timings
+
+
+if __name__ == "__main__":
+    benchmark_detection()